@@ -33,6 +33,67 @@ from atm.metrics import cross_validate_pipeline, test_pipeline
 logger = logging.getLogger('atm')
 
 
+def load_encoded_data(dataset, class_column, testing_ratio=0.3, random_state=0):
+    """Load a dataset, split it and encode it into feature matrices and labels.
+
+    Args:
+        dataset (Dataset):
+            Dataset object from database.
+        class_column (str):
+            Name of the column that contains the labels.
+        testing_ratio (float):
+            Proportion of the data to hold out for testing, if the dataset
+            does not have a separate test file.
+        random_state (int):
+            Seed used to split the data.
+
+    Returns:
+        tuple:
+            The fitted ``DataEncoder`` followed by the ``X_train``, ``y_train``,
+            ``X_test`` and ``y_test`` arrays.
+    """
+    train_data, test_data = dataset.load(testing_ratio, random_state)
+
+    # extract feature matrix and labels from raw data
+    encoder = DataEncoder(class_column=class_column)
+    encoder.fit(train_data)
+    X_train, y_train = encoder.transform(train_data)
+    X_test, y_test = encoder.transform(test_data)
+
+    return encoder, X_train, y_train, X_test, y_test
+
+
+def subsample(X, y, fraction, random_state=0, min_per_class=0):
+    """Take a random subsample of the rows of X and y, stratified by y.
+
+    Args:
+        X (numpy.ndarray):
+            Feature matrix.
+        y (numpy.ndarray):
+            Labels.
+        fraction (float):
+            Proportion of the rows of each class to keep.
+        random_state (int):
+            Seed used to sample the rows.
+        min_per_class (int):
+            Minimum number of rows to keep of each class, or all of them if the
+            class has fewer rows, so the subsample can still be cross-validated.
+
+    Returns:
+        tuple:
+            The subsampled ``X`` and ``y``.
+    """
+    random = np.random.RandomState(random_state)
+    index = []
+    for label in np.unique(y):
+        rows = np.flatnonzero(y == label)
+        size = max(int(round(fraction * len(rows))), min(min_per_class, len(rows)))
+        index.append(random.choice(rows, size, replace=False))
+
+    index = np.sort(np.concatenate(index))
+    return X[index], y[index]
+
+
 class Model(object):
     """
     This class contains everything needed to run an end-to-end ATM classifier
@@ -55,7 +116,8 @@ class Model(object):
     N_FOLDS = 5
 
     def __init__(self, method, params, judgment_metric, class_column,
-                 testing_ratio=0.3, verbose_metrics=False):
+                 testing_ratio=0.3, verbose_metrics=False, random_state=None, n_jobs=1,
+                 stop_below=None, fidelity=None, curve_points=None):
         """
         Parameters:
             method: the short method code (as defined in constants.py) or path
@@ -64,6 +126,19 @@ class Model(object):
             judgment_metric: string that indicates which metric should be
                 optimized for.
             class_column: sklearn classifier class
+            random_state: seed used to split the dataset into train and test.
+                If not given, a random one is generated.
+            n_jobs: number of cross-validation folds to fit in parallel.
+            stop_below: if given, stop the cross-validation as soon as the mean
+                judgment metric of the folds fitted so far is below this value,
+                and skip training and testing the final model.
+            fidelity: if given, proportion of the training data, sampled at
+                random, that is used to cross-validate and train the model.
+                At least N_FOLDS rows of each class are kept, so the sample
+                can be cross-validated. The model is always tested on the
+                whole testing data.
+            curve_points: if given, maximum number of points stored for each
+                ROC and PR curve of the verbose metrics.
         """
         # configuration & database
         self.method = method
@@ -72,6 +147,11 @@ class Model(object):
         self.class_column = class_column
         self.testing_ratio = testing_ratio
         self.verbose_metrics = verbose_metrics
+        self.curve_points = curve_points
+        self.n_jobs = n_jobs
+        self.stop_below = stop_below
+        self.stopped_early = False
+        self.fidelity = fidelity
 
         # load the classifier method's class
         path = Method(method).class_path.split('.')
@@ -83,7 +163,10 @@ class Model(object):
         self.pipeline = None
 
         # persistent random state
-        self.random_state = np.random.randint(1e7)
+        if random_state is None:
+            random_state = np.random.randint(1e7)
+
+        self.random_state = random_state
 
     def _make_pipeline(self):
         """
@@ -130,15 +213,24 @@ class Model(object):
         kwargs = {}
         if self.verbose_metrics:
             kwargs['include_curves'] = True
+            kwargs['curve_points'] = self.curve_points
             if not binary:
                 kwargs['include_per_class'] = True
 
-        df, cv_scores = cross_validate_pipeline(pipeline=self.pipeline,
-                                                X=X, y=y, binary=binary,
-                                                n_folds=self.N_FOLDS, **kwargs)
+        scores, cv_scores = cross_validate_pipeline(pipeline=self.pipeline,
+                                                    X=X, y=y, binary=binary,
+                                                    n_folds=self.N_FOLDS, n_jobs=self.n_jobs,
+                                                    stop_metric=self.judgment_metric,
+                                                    stop_below=self.stop_below,
+                                                    **kwargs)
+
+        # only the folds fitted before stopping early, if that happened, are scored
+        self.cv_folds = len(cv_scores)
+        self.stopped_early = self.cv_folds < self.N_FOLDS
+        judgment_scores = scores[self.judgment_metric][:self.cv_folds]
 
-        self.cv_judgment_metric = np.mean(df[self.judgment_metric])
-        self.cv_judgment_metric_stdev = np.std(df[self.judgment_metric])
+        self.cv_judgment_metric = np.mean(judgment_scores)
+        self.cv_judgment_metric_stdev = np.std(judgment_scores)
         cv_stdev = (2 * self.cv_judgment_metric_stdev)
         self.mu_sigma_judgment_metric = self.cv_judgment_metric - cv_stdev
 
@@ -160,6 +252,7 @@ class Model(object):
         kwargs = {}
         if self.verbose_metrics:
             kwargs['include_curves'] = True
+            kwargs['curve_points'] = self.curve_points
             if not binary:
                 kwargs['include_per_class'] = True
 
@@ -171,12 +264,17 @@ class Model(object):
 
         return test_scores
 
-    def train_test(self, dataset):
+    def train_test(self, dataset, data=None):
         """Train and test this model using Cross Validation and Holdout.
 
         Args:
             dataset (Dataset):
                 Dataset object from database.
+            data (tuple):
+                Already encoded data, as returned by ``load_encoded_data``.
+                Optional. If not given, the dataset will be loaded, split
+                and encoded using the ``testing_ratio`` and ``random_state``
+                of this model.
 
         Returns:
             dict:
@@ -184,8 +282,36 @@ class Model(object):
                     * cv (list): The cross validation scores array
                     * test (dict): The test scores dictionary
         """
-        self.num_classes = dataset.k_classes
-        self.num_features = dataset.d_features
+        # load and encode the training and testing data
+        if data is None:
+            data = load_encoded_data(dataset, self.class_column,
+                                     self.testing_ratio, self.random_state)
+
+        return self.train_test_encoded(data, dataset.k_classes, dataset.d_features)
+
+    def train_test_encoded(self, data, num_classes, num_features):
+        """Train and test this model on already encoded data.
+
+        This does not need access to the ``Dataset`` object, so it can be
+        run in a separate process.
+
+        Args:
+            data (tuple):
+                Encoded data, as returned by ``load_encoded_data``.
+            num_classes (int):
+                Number of classes in the dataset.
+            num_features (int):
+                Number of features in the dataset.
+
+        Returns:
+            dict:
+                Dictionary containing:
+                    * cv (list): The cross validation scores array
+                    * test (dict): The test scores dictionary, which is empty
+                      if the cross validation stopped early.
+        """
+        self.num_classes = num_classes
+        self.num_features = num_features
 
         # if necessary, cast judgment metric into its binary/multiary equivalent
         if self.num_classes == 2:
@@ -200,19 +326,23 @@ class Model(object):
             elif self.judgment_metric == Metrics.ROC_AUC:
                 self.judgment_metric = Metrics.ROC_AUC_MACRO
 
-        # load training data
-        train_data, test_data = dataset.load(self.testing_ratio, self.random_state)
-
-        # extract feature matrix and labels from raw data
-        self.encoder = DataEncoder(class_column=self.class_column)
-        self.encoder.fit(train_data)
-        X_train, y_train = self.encoder.transform(train_data)
-        X_test, y_test = self.encoder.transform(test_data)
+        self.encoder, X_train, y_train, X_test, y_test = data
+        if self.fidelity is not None and self.fidelity < 1:
+            X_train, y_train = subsample(X_train, y_train, self.fidelity, self.random_state,
+                                         min_per_class=self.N_FOLDS)
 
         # create and cross-validate pipeline
         self._make_pipeline()
         cv_scores = self._cross_validate(X_train, y_train)
 
+        if self.stopped_early:
+            # not worth training and testing the final model
+            logger.info('Stopped after %d folds: %s = %.3f is below %.3f',
+                        self.cv_folds, self.judgment_metric,
+                        self.cv_judgment_metric, self.stop_below)
+            self.test_judgment_metric = None
+            return {'cv': cv_scores, 'test': {}}
+
         # train and test the final model
         self.pipeline.fit(X_train, y_train)
         test_scores = self._test_final_model(X_test, y_test)
@@ -44,7 +44,11 @@ def _work(args, wait=False):
         save_files=args.save_files,
         cloud_mode=args.cloud_mode,
         total_time=getattr(args, 'total_time', None),
-        wait=wait
+        wait=wait,
+        processes=args.processes,
+        tuner_batch_size=args.tuner_batch_size,
+        classifiers_per_claim=args.classifiers_per_claim,
+        worker_cache_mb=args.worker_cache_mb
     )
 
 
@@ -267,6 +271,17 @@ def _get_parser():
                              help='Whether to run this worker in cloud mode')
     worker_args.add_argument('--no-save', dest='save_files', action='store_false',
                              help="don't save models and metrics at all")
+    worker_args.add_argument('--processes', default=1, type=int,
+                             help='Number of classifiers to train concurrently in each worker')
+    worker_args.add_argument('--tuner-batch-size', default=1, type=int,
+                             help='Number of hyperparameter proposals to get from each tuner fit')
+    worker_args.add_argument('--classifiers-per-claim', type=int,
+                             help='Number of classifiers to run on a datarun before claiming '
+                                  'the next one. By default, work on each datarun until it '
+                                  'is complete')
+    worker_args.add_argument('--worker-cache-mb', default=1024, type=int,
+                             help='Memory budget, in megabytes, for the data cached by the '
+                                  'workers of the claimed dataruns')
 
     # Worker
     worker_parents = [
@@ -160,6 +160,21 @@ class SQLConfig(Config):
     host = 'Hostname for database machine'
     port = 'Port used to connect to database'
     query = 'Specify extra login details'
+    pool_size = {
+        'help': 'Number of connections to keep open in the connection pool',
+        'type': int,
+        'default': None
+    }
+    max_overflow = {
+        'help': 'Number of connections to open beyond pool_size when needed',
+        'type': int,
+        'default': None
+    }
+    pool_recycle = {
+        'help': 'Number of seconds after which pooled connections are replaced',
+        'type': int,
+        'default': None
+    }
 
 
 class LogConfig(Config):
@@ -173,6 +188,16 @@ class LogConfig(Config):
         'action': 'store_true',
         'default': False
     }
+    curve_points = {
+        'help': (
+            'Maximum number of points stored for each ROC and PR curve of the '
+            'verbose metrics. All of them are stored if not given'
+        ),
+        'type': int,
+        'default': None
+    }
+    data_cache_dir = ('Directory where the parsed data of the datasets is cached. '
+                      'Not cached if not given')
 
 
 def _option_or_path(options, regex=CUSTOM_CLASS_REGEX):
@@ -193,6 +218,14 @@ def _option_or_path(options, regex=CUSTOM_CLASS_REGEX):
     return type_check
 
 
+def _fraction(s):
+    value = float(s)
+    if not 0 < value <= 1:
+        raise argparse.ArgumentTypeError('{} is not in the (0, 1] interval!'.format(s))
+
+    return value
+
+
 class RunConfig(Config):
     """Stores configuration for Dataset and Datarun setup."""
     _CONFIG = 'run'
@@ -381,3 +414,31 @@ class RunConfig(Config):
         'default': 0,
         'type': int
     }
+
+    # n_jobs is the number of cross-validation folds that are fitted in
+    # parallel for each classifier. -1 means using all the available cores.
+    n_jobs = {
+        'help': 'number of cross-validation folds to fit in parallel (-1: all cores)',
+        'default': 1,
+        'type': int
+    }
+
+    # early_stopping enables stopping the cross-validation of a classifier as
+    # soon as the mean score of its first folds is below the median score of
+    # the completed classifiers of its hyperpartition. Only used with the cv
+    # score target.
+    early_stopping = {
+        'help': 'if true, stop cross-validating classifiers that score below the median',
+        'default': False,
+        'action': 'store_true',
+    }
+
+    # min_fidelity enables a multi-fidelity search: new classifiers are trained
+    # on a stratified subsample of the training data, and the best third of
+    # each level is trained again on three times more data, up to all of it.
+    min_fidelity = {
+        'help': ('if given, train new classifiers on this proportion of the training data '
+                 'and promote the best third of them to three times more data'),
+        'default': None,
+        'type': _fraction
+    }
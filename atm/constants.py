@@ -33,6 +33,10 @@ JSON_REGEX = r'(.*\.json)$'
 
 N_FOLDS_DEFAULT = 10
 
+# in a multi-fidelity search, each level trains the classifiers on FIDELITY_ETA
+# times more data than the previous one, and promotes 1 / FIDELITY_ETA of them
+FIDELITY_ETA = 3
+
 LOG_LEVELS = {
     'CRITICAL': logging.CRITICAL,
     'ERROR': logging.ERROR,
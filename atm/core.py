@@ -7,10 +7,9 @@ executing and orchestrating the main ATM functionalities.
 """
 
 import logging
-import random
 import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from operator import attrgetter
 
 from tqdm import tqdm
 
@@ -22,6 +21,82 @@ from atm.worker import ClassifierError, Worker
 LOGGER = logging.getLogger(__name__)
 
 
+class _WorkerCache(object):
+    """
+    LRU cache of Workers, by datarun id.
+
+    On eviction, the Workers whose datarun has been completed, possibly by
+    another process, are closed and dropped. Then, while the data cached by
+    all the Workers uses more than ``max_bytes`` or there are more than
+    ``max_workers`` of them, the least recently used Workers are closed and
+    dropped. The most recently used one is always kept.
+    """
+
+    def __init__(self, db, max_bytes=None, max_workers=10):
+        self.db = db
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+        self._workers = OrderedDict()
+
+    def get(self, datarun_id):
+        """Get the Worker of a datarun and mark it as the most recently used."""
+        worker = self._workers.pop(datarun_id, None)
+        if worker is not None:
+            self._workers[datarun_id] = worker
+
+        return worker
+
+    def add(self, datarun_id, worker):
+        self._workers[datarun_id] = worker
+
+    def remove(self, datarun_id):
+        """Close and drop the Worker of a datarun."""
+        self._workers.pop(datarun_id).close()
+
+    def suspend(self, keep=None):
+        """
+        Shut down the process pools and the S3 uploader threads of all the
+        Workers but the one of the ``keep`` datarun. This way their classifiers
+        are not left running while other dataruns are worked on, and no
+        uploader thread is running when the next pool forks its processes.
+        """
+        for datarun_id, worker in self._workers.items():
+            if datarun_id != keep:
+                worker.close()
+
+    def _over_budget(self, nbytes):
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return True
+
+        return self.max_workers is not None and len(self._workers) > self.max_workers
+
+    def evict(self):
+        """
+        Close and drop the Workers of completed dataruns, and then the least
+        recently used Workers until within budget.
+        """
+        if self._workers:
+            complete = self.db.get_dataruns(ignore_pending=True, ignore_running=True,
+                                            ignore_complete=False,
+                                            include_ids=list(self._workers),
+                                            max_priority=False)
+            for datarun in complete or []:
+                LOGGER.debug('Dropping the worker of complete datarun %d', datarun.id)
+                self.remove(datarun.id)
+
+        nbytes = sum(worker.data_nbytes() for worker in self._workers.values())
+        while len(self._workers) > 1 and self._over_budget(nbytes):
+            datarun_id, worker = self._workers.popitem(last=False)
+            LOGGER.debug('Dropping the worker of datarun %d', datarun_id)
+            nbytes -= worker.data_nbytes()
+            worker.close()
+
+    def close(self):
+        """Close and drop all the Workers."""
+        while self._workers:
+            self._workers.popitem(last=False)[1].close()
+
+
 class ATM(object):
 
     _LOOP_WAIT = 5
@@ -37,6 +112,9 @@ class ATM(object):
         host=None,
         port=None,
         query=None,
+        pool_size=None,
+        max_overflow=None,
+        pool_recycle=None,
 
         # AWS Conf
         access_key=None,
@@ -48,9 +126,12 @@ class ATM(object):
         models_dir='models',
         metrics_dir='metrics',
         verbose_metrics=False,
+        curve_points=None,
+        data_cache_dir=None,
     ):
 
-        self.db = Database(dialect, database, username, host, port, query)
+        self.db = Database(dialect, database, username, password, host, port, query,
+                           pool_size, max_overflow, pool_recycle, data_cache_dir)
         self.aws_access_key = access_key
         self.aws_secret_key = secret_key
         self.s3_bucket = s3_bucket
@@ -59,6 +140,7 @@ class ATM(object):
         self.models_dir = models_dir
         self.metrics_dir = metrics_dir
         self.verbose_metrics = verbose_metrics
+        self.curve_points = curve_points
 
     def add_dataset(self, train_path, test_path=None, name=None,
                     description=None, class_column=None):
@@ -102,7 +184,8 @@ class ATM(object):
     def add_datarun(self, dataset_id, budget=100, budget_type='classifier',
                     gridding=0, k_window=3, metric='f1', methods=['logreg', 'dt', 'knn'],
                     r_minimum=2, run_per_partition=False, score_target='cv', priority=1,
-                    selector='uniform', tuner='uniform', deadline=None):
+                    selector='uniform', tuner='uniform', deadline=None, n_jobs=1,
+                    early_stopping=False, min_fidelity=None):
 
         """Register one or more Dataruns to the Database.
 
@@ -144,11 +227,31 @@ class ATM(object):
             deadline (str):
                 Time deadline. It must be a string representing a datetime in the format
                 ``'%Y-%m-%d %H:%M'``. If given, ``budget_type`` will be set to ``'walltime'``.
+            n_jobs (int):
+                Number of cross-validation folds to fit in parallel for each classifier.
+                ``-1`` means using all the available cores. Optional. Defaults to ``1``.
+            early_stopping (bool):
+                Whether to stop the cross-validation of a classifier as soon as the mean
+                score of its first folds is below the median score of the completed
+                classifiers of its hyperpartition. Only used with the ``'cv'`` score
+                target. Optional. Defaults to ``False``.
+            min_fidelity (float):
+                If given, run a multi-fidelity search: new classifiers are trained on
+                this proportion of the training data, rounded up to a power of
+                ``1 / 3``, and the best third of the classifiers of each fidelity level
+                are trained again on three times more data, up to the full data.
+                Optional. Defaults to ``None``.
 
         Returns:
             Datarun:
                 The created Datarun or list of Dataruns.
+
+        Raises:
+            ValueError:
+                If ``min_fidelity`` is not in the ``(0, 1]`` interval.
         """
+        if min_fidelity is not None and not 0 < min_fidelity <= 1:
+            raise ValueError('min_fidelity must be in the (0, 1] interval')
 
         if deadline:
             deadline = datetime.strptime(deadline, TIME_FMT)
@@ -169,56 +272,47 @@ class ATM(object):
             LOGGER.info('method {} has {} hyperpartitions'.format(
                 method, len(method_parts[method])))
 
-        dataruns = list()
-        if not run_per_partition:
-            datarun = self.db.create_datarun(
-                dataset_id=dataset_id,
-                description=run_description,
-                tuner=tuner,
-                selector=selector,
-                gridding=gridding,
-                priority=priority,
-                budget_type=budget_type,
-                budget=budget,
-                deadline=deadline,
-                metric=metric,
-                score_target=target,
-                k_window=k_window,
-                r_minimum=r_minimum
+        datarun_args = dict(
+            dataset_id=dataset_id,
+            description=run_description,
+            tuner=tuner,
+            selector=selector,
+            gridding=gridding,
+            priority=priority,
+            budget_type=budget_type,
+            budget=budget,
+            deadline=deadline,
+            metric=metric,
+            score_target=target,
+            k_window=k_window,
+            r_minimum=r_minimum,
+            n_jobs=n_jobs,
+            early_stopping=early_stopping,
+            min_fidelity=min_fidelity
+        )
+
+        hyperpartitions = [
+            dict(
+                method=method,
+                tunables=part.tunables,
+                constants=part.constants,
+                categoricals=part.categoricals,
+                status=PartitionStatus.INCOMPLETE
             )
+            for method, parts in method_parts.items()
+            for part in parts
+        ]
 
-            dataruns.append(datarun)
-
-        for method, parts in method_parts.items():
-            for part in parts:
-                # if necessary, create a new datarun for each hyperpartition.
-                # This setting is useful for debugging.
-                if run_per_partition:
-                    datarun = self.db.create_datarun(
-                        dataset_id=dataset_id,
-                        description=run_description,
-                        tuner=tuner,
-                        selector=selector,
-                        gridding=gridding,
-                        priority=priority,
-                        budget_type=budget_type,
-                        budget=budget,
-                        deadline=deadline,
-                        metric=metric,
-                        score_target=target,
-                        k_window=k_window,
-                        r_minimum=r_minimum
-                    )
-
-                    dataruns.append(datarun)
-
-                # create a new hyperpartition in the database
-                self.db.create_hyperpartition(datarun_id=datarun.id,
-                                              method=method,
-                                              tunables=part.tunables,
-                                              constants=part.constants,
-                                              categoricals=part.categoricals,
-                                              status=PartitionStatus.INCOMPLETE)
+        # if necessary, create a new datarun for each hyperpartition.
+        # This setting is useful for debugging.
+        if run_per_partition:
+            datarun_hyperpartitions = [[hyperpartition] for hyperpartition in hyperpartitions]
+        else:
+            datarun_hyperpartitions = [hyperpartitions]
+
+        # create all the dataruns and hyperpartitions in a single transaction
+        datarun_args = [datarun_args] * len(datarun_hyperpartitions)
+        dataruns = self.db.create_dataruns(datarun_args, datarun_hyperpartitions)
 
         dataset = self.db.get_dataset(dataset_id)
         LOGGER.info('Dataruns created. Summary:')
@@ -239,14 +333,28 @@ class ATM(object):
 
         return dataruns if run_per_partition else dataruns[0]
 
+    @staticmethod
+    def _run_classifiers(worker, processes):
+        if processes > 1:
+            worker.run_classifiers(processes)
+        else:
+            worker.run_classifier()
+
     def work(self, datarun_ids=None, save_files=True, choose_randomly=True,
-             cloud_mode=False, total_time=None, wait=True, verbose=False):
+             cloud_mode=False, total_time=None, wait=True, verbose=False, processes=1,
+             tuner_batch_size=1, classifiers_per_claim=None, worker_cache_mb=1024):
         """Get unfinished Dataruns from the database and work on them.
 
         Check the ModelHub Database for unfinished Dataruns, and work on them
         as they are added. This process will continue to run until it exceeds
         total_time or there are no more Dataruns to process or it is killed.
 
+        Dataruns are claimed atomically, so concurrent workers spread over them,
+        and the Worker of each claimed Datarun, with its cached data, is kept
+        alive until the Datarun is complete or the ``worker_cache_mb`` budget
+        is exceeded. Only the Worker of the Datarun being worked on keeps its
+        pool of processes alive.
+
         Args:
             datarun_ids (list):
                 list of IDs of Dataruns to work on. If ``None``, this will work on any
@@ -255,7 +363,8 @@ class ATM(object):
                 Whether to save the fitted classifiers and their metrics or not.
                 Optional. Defaults to True.
             choose_randomly (bool):
-                If ``True``, work on all the highest-priority dataruns in random order.
+                If ``True``, spread the work over all the highest-priority dataruns,
+                claiming first the one that was claimed the longest time ago.
                 Otherwise, work on them in sequential order (by ID).
                 Optional. Defaults to ``True``.
             cloud_mode (bool):
@@ -273,92 +382,123 @@ class ATM(object):
                 Optional. Defaults to ``False``.
             verbose (bool):
                 Whether to be verbose about the process. Optional. Defaults to ``True``.
+            processes (int):
+                Number of classifiers to train concurrently, each one in its own process.
+                Optional. Defaults to ``1``.
+            tuner_batch_size (int):
+                Number of hyperparameter proposals to get from each tuner fit. The ones
+                not used right away are queued for the next classifiers.
+                Optional. Defaults to ``1``.
+            classifiers_per_claim (int):
+                Number of classifiers to run on a datarun before claiming the next one,
+                which may be a different datarun. If ``None``, keep working on each
+                claimed datarun until it is complete. Optional. Defaults to ``None``.
+            worker_cache_mb (int):
+                Memory budget, in megabytes, for the data cached by the Workers of the
+                claimed Dataruns, including the copies held by their processes. When
+                exceeded, the least recently used Workers are dropped. If ``None``, only
+                the number of cached Workers is limited. Optional. Defaults to ``1024``.
         """
         start_time = datetime.now()
 
-        # main loop
-        while True:
-            # get all pending and running dataruns, or all pending/running dataruns
-            # from the list we were given
-            dataruns = self.db.get_dataruns(include_ids=datarun_ids, ignore_complete=True)
-            if not dataruns:
-                if wait:
-                    LOGGER.debug('No dataruns found. Sleeping %d seconds and trying again.',
-                                 self._LOOP_WAIT)
+        # workers of the dataruns claimed so far, kept alive between claims
+        max_bytes = worker_cache_mb * 1024 * 1024 if worker_cache_mb is not None else None
+        workers = _WorkerCache(self.db, max_bytes)
+
+        try:
+            # main loop
+            while True:
+                # claim the next pending or running datarun, or the next one from the
+                # list we were given, and mark it as running
+                run = self.db.claim_datarun(include_ids=datarun_ids, by_id=not choose_randomly)
+                workers.suspend(keep=run.id if run is not None else None)
+                if run is None:
+                    if wait:
+                        LOGGER.debug('No dataruns found. Sleeping %d seconds and trying again.',
+                                     self._LOOP_WAIT)
+                        time.sleep(self._LOOP_WAIT)
+                        continue
+
+                    else:
+                        LOGGER.info('No dataruns found. Exiting.')
+                        break
+
+                LOGGER.info('Computing on datarun %d' % run.id)
+                worker = workers.get(run.id)
+                if worker is None:
+                    worker = Worker(self.db, run, save_files=save_files,
+                                    cloud_mode=cloud_mode, aws_access_key=self.aws_access_key,
+                                    aws_secret_key=self.aws_secret_key,
+                                    s3_bucket=self.s3_bucket, s3_folder=self.s3_folder,
+                                    models_dir=self.models_dir, metrics_dir=self.metrics_dir,
+                                    verbose_metrics=self.verbose_metrics,
+                                    tuner_batch_size=tuner_batch_size,
+                                    curve_points=self.curve_points)
+                    workers.add(run.id, worker)
+
+                try:
+                    # actual work happens here
+                    run = self._work_on_datarun(worker, run, processes,
+                                                classifiers_per_claim, verbose)
+
+                except ClassifierError:
+                    # the exception has already been handled; just wait a sec so we
+                    # don't go out of control reporting errors
+                    LOGGER.error('Something went wrong. Sleeping %d seconds.', self._LOOP_WAIT)
                     time.sleep(self._LOOP_WAIT)
-                    continue
 
-                else:
-                    LOGGER.info('No dataruns found. Exiting.')
+                if run.status == RunStatus.COMPLETE:
+                    workers.remove(run.id)
+
+                workers.evict()
+
+                elapsed_time = (datetime.now() - start_time).total_seconds()
+                if total_time is not None and elapsed_time >= total_time:
+                    LOGGER.info('Total run time for worker exceeded; exiting.')
                     break
 
-            # either choose a run randomly between priority, or take the run with the lowest ID
-            if choose_randomly:
-                run = random.choice(dataruns)
-            else:
-                run = sorted(dataruns, key=attrgetter('id'))[0]
-
-            # say we've started working on this datarun, if we haven't already
-            self.db.mark_datarun_running(run.id)
-
-            LOGGER.info('Computing on datarun %d' % run.id)
-            # actual work happens here
-            worker = Worker(self.db, run, save_files=save_files,
-                            cloud_mode=cloud_mode, aws_access_key=self.aws_access_key,
-                            aws_secret_key=self.aws_secret_key, s3_bucket=self.s3_bucket,
-                            s3_folder=self.s3_folder, models_dir=self.models_dir,
-                            metrics_dir=self.metrics_dir, verbose_metrics=self.verbose_metrics)
-
-            try:
-                if run.budget_type == 'classifier':
-                    pbar = tqdm(
-                        total=run.budget,
-                        ascii=True,
-                        initial=run.completed_classifiers,
-                        disable=not verbose
-                    )
-
-                    while run.status != RunStatus.COMPLETE:
-                        worker.run_classifier()
-                        run = self.db.get_datarun(run.id)
-                        if verbose and run.completed_classifiers > pbar.last_print_n:
-                            pbar.update(run.completed_classifiers - pbar.last_print_n)
-
-                    pbar.close()
-
-                elif run.budget_type == 'walltime':
-                    pbar = tqdm(
-                        disable=not verbose,
-                        ascii=True,
-                        initial=run.completed_classifiers,
-                        unit=' Classifiers'
-                    )
-
-                    while run.status != RunStatus.COMPLETE:
-                        worker.run_classifier()
-                        run = self.db.get_datarun(run.id)  # Refresh the datarun object.
-                        if verbose and run.completed_classifiers > pbar.last_print_n:
-                            pbar.update(run.completed_classifiers - pbar.last_print_n)
-
-                    pbar.close()
-
-            except ClassifierError:
-                # the exception has already been handled; just wait a sec so we
-                # don't go out of control reporting errors
-                LOGGER.error('Something went wrong. Sleeping %d seconds.', self._LOOP_WAIT)
-                time.sleep(self._LOOP_WAIT)
-
-            elapsed_time = (datetime.now() - start_time).total_seconds()
-            if total_time is not None and elapsed_time >= total_time:
-                LOGGER.info('Total run time for worker exceeded; exiting.')
+        finally:
+            workers.close()
+
+    def _work_on_datarun(self, worker, run, processes, max_classifiers, verbose):
+        """
+        Run classifiers of the given datarun until it is complete or, if given,
+        max_classifiers have been run. Returns the refreshed datarun.
+        """
+        if run.budget_type == 'classifier':
+            pbar_args = {'total': run.budget}
+        else:
+            pbar_args = {'unit': ' Classifiers'}
+
+        pbar = tqdm(
+            ascii=True,
+            initial=run.completed_classifiers,
+            disable=not verbose,
+            **pbar_args
+        )
+
+        iterations = 0
+        while run.status != RunStatus.COMPLETE:
+            if max_classifiers and iterations >= max_classifiers:
                 break
 
+            self._run_classifiers(worker, processes)
+            iterations += 1
+
+            run = self.db.get_datarun(run.id)  # Refresh the datarun object.
+            completed_classifiers = run.completed_classifiers
+            if verbose and completed_classifiers > pbar.last_print_n:
+                pbar.update(completed_classifiers - pbar.last_print_n)
+
+        pbar.close()
+        return run
+
     def run(self, train_path, test_path=None, name=None, description=None,
             class_column='class', budget=100, budget_type='classifier', gridding=0, k_window=3,
             metric='f1', methods=['logreg', 'dt', 'knn'], r_minimum=2, run_per_partition=False,
             score_target='cv', selector='uniform', tuner='uniform', deadline=None, priority=1,
             save_files=True, choose_randomly=True, cloud_mode=False, total_time=None,
-            verbose=True):
+            verbose=True, n_jobs=1, early_stopping=False, min_fidelity=None):
 
         """Create a Dataset and a Datarun and then work on it.
 
@@ -413,6 +553,20 @@ class ATM(object):
                 ``'%Y-%m-%d %H:%M'``. If given, ``budget_type`` will be set to ``'walltime'``.
             verbose (bool):
                 Whether to be verbose about the process. Optional. Defaults to ``True``.
+            n_jobs (int):
+                Number of cross-validation folds to fit in parallel for each classifier.
+                ``-1`` means using all the available cores. Optional. Defaults to ``1``.
+            early_stopping (bool):
+                Whether to stop the cross-validation of a classifier as soon as the mean
+                score of its first folds is below the median score of the completed
+                classifiers of its hyperpartition. Only used with the ``'cv'`` score
+                target. Optional. Defaults to ``False``.
+            min_fidelity (float):
+                If given, run a multi-fidelity search: new classifiers are trained on
+                this proportion of the training data, rounded up to a power of
+                ``1 / 3``, and the best third of the classifiers of each fidelity level
+                are trained again on three times more data, up to the full data.
+                Optional. Defaults to ``None``.
 
         Returns:
             Datarun:
@@ -434,7 +588,10 @@ class ATM(object):
             priority,
             selector,
             tuner,
-            deadline
+            deadline,
+            n_jobs,
+            early_stopping,
+            min_fidelity
         )
 
         if run_per_partition:
@@ -1,9 +1,11 @@
 import glob
+import json
 import logging
 import os
 import shutil
 
 import boto3
+import numpy as np
 import pandas as pd
 import requests
 from botocore import UNSIGNED
@@ -12,6 +14,10 @@ from botocore.exceptions import ClientError
 
 LOGGER = logging.getLogger('atm')
 
+# version of the layout of the cached parsed data. Caches with a different
+# version are rebuilt from the CSV.
+CACHE_VERSION = 2
+
 
 def copy_files(extension, source, target=None):
     """Copy matching files from source to target.
@@ -178,12 +184,108 @@ def _get_local_path(name, path, aws_access_key=None, aws_secret_key=None):
         return local_path
 
 
-def load_data(name, path, aws_access_key=None, aws_secret_key=None):
+def _get_cache_path(name, cache_dir):
+    if name.endswith('.csv'):
+        name = name[:-len('.csv')]
+
+    return os.path.join(cache_dir, name + '.columns')
+
+
+def _get_source_info(local_path):
+    stat = os.stat(local_path)
+    return {
+        'source': os.path.abspath(local_path),
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+    }
+
+
+def _write_cache(data, cache_path, source_info):
+    """Store a parsed DataFrame as a directory with one ``.npy`` file per column.
+
+    Text columns are stored as integer category codes plus a small array
+    with the distinct values, so a single long value does not widen the
+    whole column. The directory is written under a temporary name and then
+    renamed, so concurrent workers never see a partial copy.
+    """
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+
+    os.makedirs(tmp_path)
+
+    columns = list()
+    for index, column in enumerate(data.columns):
+        values = np.asarray(data[column])
+        is_object = values.dtype.kind == 'O'
+        if is_object:
+            codes, categories = pd.factorize(values)
+            dtype = np.int32 if len(categories) < np.iinfo(np.int32).max else np.int64
+            values = codes.astype(dtype)
+
+            categories_path = os.path.join(tmp_path, '{}.categories.npy'.format(index))
+            np.save(categories_path, np.asarray(categories).astype('U'))
+
+        np.save(os.path.join(tmp_path, '{}.npy'.format(index)), values)
+        columns.append({'name': column, 'object': bool(is_object)})
+
+    metadata = dict(source_info, columns=columns, version=CACHE_VERSION)
+    with open(os.path.join(tmp_path, 'metadata.json'), 'w') as metadata_file:
+        json.dump(metadata, metadata_file)
+
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path, ignore_errors=True)
+
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another process stored the same data in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _read_cache(cache_path, source_info):
+    """Load a DataFrame stored by ``_write_cache``.
+
+    Returns ``None`` if there is no stored copy or if it is older than the
+    CSV file it was generated from.
+    """
+    metadata_path = os.path.join(cache_path, 'metadata.json')
+    if not os.path.isfile(metadata_path):
+        return None
+
+    with open(metadata_path) as metadata_file:
+        metadata = json.load(metadata_file)
+
+    if metadata.get('version') != CACHE_VERSION:
+        return None
+
+    if any(metadata.get(key) != value for key, value in source_info.items()):
+        return None
+
+    names = list()
+    columns = dict()
+    for index, column in enumerate(metadata['columns']):
+        values = np.load(os.path.join(cache_path, '{}.npy'.format(index)))
+        if column['object']:
+            categories_path = os.path.join(cache_path, '{}.categories.npy'.format(index))
+            values = np.load(categories_path).astype(np.object_)[values]
+
+        names.append(column['name'])
+        columns[column['name']] = values
+
+    return pd.DataFrame(columns, columns=names)
+
+
+def load_data(name, path, aws_access_key=None, aws_secret_key=None, cache_dir=None):
     """Load data from the given path.
 
     If the path is an URL or an S3 path, download it and make a local copy
     of it to avoid having to dowload it later again.
 
+    If ``cache_dir`` is given, the first time a CSV is loaded the parsed data
+    is cached inside it, and later loads read the cache instead of parsing
+    the CSV again. Each load still returns its own copy of the data.
+
     Args:
         name (str):
             Name of the dataset. Used to cache the data locally.
@@ -193,6 +295,9 @@ def load_data(name, path, aws_access_key=None, aws_secret_key=None):
             AWS access key. Optional.
         aws_secret_key (str):
             AWS secret key. Optional.
+        cache_dir (str):
+            Directory where the parsed data is cached. If not given, the CSV is
+            parsed every time. Optional. Defaults to ``None``.
 
     Returns:
         pandas.DataFrame:
@@ -201,4 +306,20 @@ def load_data(name, path, aws_access_key=None, aws_secret_key=None):
     local_path = _get_local_path(
         name, path, aws_access_key=aws_access_key, aws_secret_key=aws_secret_key)
 
-    return pd.read_csv(local_path).dropna(how='any')
+    if not cache_dir:
+        return pd.read_csv(local_path).dropna(how='any')
+
+    cache_path = _get_cache_path(name, cache_dir)
+    source_info = _get_source_info(local_path)
+
+    data = _read_cache(cache_path, source_info)
+    if data is None:
+        data = pd.read_csv(local_path).dropna(how='any').reset_index(drop=True)
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        LOGGER.info('Caching the parsed data of {} at {}'.format(local_path, cache_path))
+        _write_cache(data, cache_path, source_info)
+
+    return data
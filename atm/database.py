@@ -15,32 +15,78 @@ import pandas as pd
 import pymysql
 from sklearn.model_selection import train_test_split
 from sqlalchemy import (
-    Column, DateTime, Enum, ForeignKey, Integer, MetaData, Numeric, String, Text, and_,
-    create_engine, func, inspect)
+    Boolean, Column, DateTime, Enum, ForeignKey, Index, Integer, MetaData, Numeric, String, Text,
+    create_engine, exists, func, inspect, or_)
 from sqlalchemy.engine.url import URL
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import aliased, deferred, relationship, sessionmaker, undefer
 from sqlalchemy.orm.properties import ColumnProperty
 
+from atm.classifier import Model
 from atm.constants import (
-    BUDGET_TYPES, CLASSIFIER_STATUS, DATARUN_STATUS, METRICS, PARTITION_STATUS, SCORE_TARGETS,
-    ClassifierStatus, PartitionStatus, RunStatus)
+    BUDGET_TYPES, CLASSIFIER_STATUS, DATARUN_STATUS, FIDELITY_ETA, METRICS, PARTITION_STATUS,
+    SCORE_TARGETS, ClassifierStatus, PartitionStatus, RunStatus)
 from atm.data import load_data
-from atm.utilities import base_64_to_object, object_to_base_64
+from atm.utilities import json_to_object, object_to_json
 
 # The maximum number of errors allowed in a single hyperpartition. If more than
 # this many classifiers using a hyperpartition error, the hyperpartition will be
 # considered broken and ignored for the rest of the datarun.
 MAX_HYPERPARTITION_ERRORS = 3
 
+# Number of rows read or written at a time when exporting and importing CSV snapshots.
+CSV_CHUNKSIZE = 10000
+
+
+def _decode_column(instance, column, pairs=False):
+    """
+    Decode the hyperparameters stored in a column of a model instance.
+
+    The decoded value is cached on the instance until the stored value
+    changes, and a shallow copy of it is returned so that callers can modify
+    it freely. If ``pairs`` is True, the value is a list of (name, value)
+    tuples.
+    """
+    raw = getattr(instance, column)
+    if raw is None:
+        return None
+
+    cache = getattr(instance, '_decoded_columns', None)
+    if cache is None:
+        cache = dict()
+        instance._decoded_columns = cache
+
+    cached = cache.get(column)
+    if cached is None or cached[0] is not raw:
+        value = json_to_object(raw)
+        if pairs:
+            value = [tuple(pair) for pair in value]
+
+        cached = (raw, value)
+        cache[column] = cached
+
+    value = cached[1]
+    return list(value) if pairs else dict(value)
+
 
 class DBSession(object):
+    """
+    Context manager that opens a session on the given Database.
+
+    If the Database already has an active session, it is reused and left open
+    on exit, so an outer ``with DBSession(db):`` block can be used to run several
+    operations as a single unit of work on the same session.
+    """
     def __init__(self, db, commit=False):
         self.db = db
         self.commit = commit
+        self.owner = False
 
     def __enter__(self):
-        self.db.session = self.db.get_session()
+        self.owner = self.db.session is None
+        if self.owner:
+            self.db.session = self.db.get_session()
 
     def __exit__(self, type, error, traceback):
         if error is not None:
@@ -48,8 +94,9 @@ class DBSession(object):
         elif self.commit:
             self.db.session.commit()
 
-        self.db.session.close()
-        self.db.session = None
+        if self.owner:
+            self.db.session.close()
+            self.db.session = None
 
 
 def try_with_session(commit=False):
@@ -78,11 +125,19 @@ def try_with_session(commit=False):
 
 class Database(object):
     def __init__(self, dialect, database, username=None, password=None,
-                 host=None, port=None, query=None):
+                 host=None, port=None, query=None, pool_size=None, max_overflow=None,
+                 pool_recycle=None, data_cache_dir=None):
         """
         Accepts configuration for a database connection, and defines SQLAlchemy
         ORM objects for all the tables in the database.
+
+        pool_size, max_overflow and pool_recycle are passed to the SQLAlchemy
+        connection pool if given. Otherwise, the dialect defaults are used.
+
+        data_cache_dir, if given, is the directory where the parsed data of the
+        datasets is cached by ``load_data``.
         """
+        self.data_cache_dir = data_cache_dir
 
         # Prepare environment for pymysql
         pymysql.install_as_MySQLdb()
@@ -92,11 +147,21 @@ class Database(object):
 
         db_url = URL(drivername=dialect, database=database, username=username,
                      password=password, host=host, port=port, query=query)
-        self.engine = create_engine(db_url)
+        pool_args = {
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pool_recycle': pool_recycle,
+        }
+        pool_args = {name: value for name, value in pool_args.items() if value is not None}
+        self.engine = create_engine(db_url, **pool_args)
         self.session = None
         self.get_session = sessionmaker(bind=self.engine,
                                         expire_on_commit=False)
 
+        # best classifier of each datarun, by (datarun_id, score_target), for
+        # get_best_classifier(cached=True). Updated by complete_classifier.
+        self._best_classifiers = dict()
+
         # create ORM objects for the tables
         self._define_tables()
 
@@ -107,8 +172,9 @@ class Database(object):
         These must be defined after the Database class is initialized so that
         the database metadata is available (at runtime).
         If the database does not already exist, it will be created. If it does
-        exist, it will not be updated with new schema -- after schema changes,
-        the database must be destroyed and reinialized.
+        exist, the columns and indexes that are missing from it will be added
+        by ``_upgrade_schema``. Other schema changes are not migrated -- after
+        them, the database must be destroyed and reinialized.
         """
         metadata = MetaData(bind=self.engine)
         Base = declarative_base(metadata=metadata)
@@ -135,7 +201,8 @@ class Database(object):
 
             def load(self, test_size=0.3, random_state=0,
                      aws_access_key=None, aws_secret_key=None):
-                data = load_data(self.name, self.train_path, aws_access_key, aws_secret_key)
+                data = load_data(self.name, self.train_path, aws_access_key, aws_secret_key,
+                                 cache_dir=db.data_cache_dir)
 
                 if self.test_path:
                     if self.name.endswith('.csv'):
@@ -144,7 +211,8 @@ class Database(object):
                         test_name = self.name + '_test'
 
                     test_data = load_data(test_name, self.test_path,
-                                          aws_access_key, aws_secret_key)
+                                          aws_access_key, aws_secret_key,
+                                          cache_dir=db.data_cache_dir)
                     return data, test_data
 
                 else:
@@ -152,7 +220,8 @@ class Database(object):
 
             def _add_extra_fields(self, aws_access_key=None, aws_secret_key=None):
 
-                data = load_data(self.name, self.train_path, aws_access_key, aws_secret_key)
+                data = load_data(self.name, self.train_path, aws_access_key, aws_secret_key,
+                                 cache_dir=db.data_cache_dir)
 
                 if self.n_examples is None:
                     self.n_examples = len(data)
@@ -207,6 +276,9 @@ class Database(object):
 
         class Datarun(Base):
             __tablename__ = 'dataruns'
+            __table_args__ = (
+                Index('ix_dataruns_status_priority', 'status', 'priority'),
+            )
 
             # relational columns
             id = Column(Integer, primary_key=True, autoincrement=True)
@@ -223,6 +295,16 @@ class Database(object):
             gridding = Column(Integer, nullable=False)
             r_minimum = Column(Integer)
 
+            # number of cross-validation folds to fit in parallel
+            n_jobs = Column(Integer, default=1)
+
+            # whether to stop cross-validating classifiers that score below the median
+            early_stopping = Column(Boolean, default=False)
+
+            # smallest proportion of the training data used in a multi-fidelity
+            # search, or NULL to train all the classifiers on all the data
+            min_fidelity = Column(Numeric(precision=10, scale=9))
+
             # budget settings
             budget_type = Column(Enum(*BUDGET_TYPES))
             budget = Column(Integer)
@@ -238,6 +320,9 @@ class Database(object):
             end_time = Column(DateTime)
             status = Column(Enum(*DATARUN_STATUS), default=RunStatus.PENDING)
 
+            # last time a worker claimed this datarun to work on it
+            claimed_at = Column(DateTime)
+
             def __repr__(self):
                 base = "<ID = %d, dataset ID = %s, strategy = %s, budget = %s (%s), status: %s>"
                 return base % (self.id, self.dataset_id, self.description,
@@ -245,7 +330,8 @@ class Database(object):
 
             @property
             def completed_classifiers(self):
-                return len(self.get_complete_classifiers())
+                return db.count_classifiers(datarun_id=self.id,
+                                            status=ClassifierStatus.COMPLETE)
 
             def get_scores(self):
                 columns = [
@@ -255,17 +341,8 @@ class Database(object):
                     'test_judgment_metric',
                 ]
 
-                classifiers = db.get_classifiers(datarun_id=self.id)
-                scores = [
-                    {
-                        key: value
-                        for key, value in vars(classifier).items()
-                        if key in columns
-                    }
-                    for classifier in classifiers
-                ]
-
-                scores = pd.DataFrame(scores)
+                scores = db.get_classifiers_values(columns, datarun_id=self.id)
+                scores = pd.DataFrame(scores, columns=columns)
                 scores.sort_values(by='cv_judgment_metric', ascending=False, inplace=True)
                 scores['rank'] = scores['cv_judgment_metric'].rank(ascending=0)
 
@@ -302,7 +379,7 @@ class Database(object):
                     "\tDataset: '{}'".format(dataset.train_path),
                     "\tColumn Name: '{}'".format(dataset.class_column),
                     "\tJudgment Metric: '{}'".format(self.metric),
-                    '\tClassifiers Tested: {}'.format(len(db.get_classifiers(datarun_id=self.id))),
+                    '\tClassifiers Tested: {}'.format(db.count_classifiers(datarun_id=self.id)),
                     '\tElapsed Time: {}'.format(elapsed),
                 ]
 
@@ -313,6 +390,9 @@ class Database(object):
 
         class Hyperpartition(Base):
             __tablename__ = 'hyperpartitions'
+            __table_args__ = (
+                Index('ix_hyperpartitions_datarun_id_status', 'datarun_id', 'status'),
+            )
 
             # relational columns
             id = Column(Integer, primary_key=True, autoincrement=True)
@@ -322,6 +402,8 @@ class Database(object):
             # name of or path to a configured classification method
             method = Column(String(255))
 
+            # the *_64 columns below store JSON (base 64 pickle in old rows)
+
             # list of categorical parameters whose values are fixed to define
             # this hyperpartition
             categorical_hyperparameters_64 = Column(Text)
@@ -346,11 +428,11 @@ class Database(object):
                 which define this hyperpartition.
                 Each element is a ('name', HyperParameter) tuple.
                 """
-                return base_64_to_object(self.categorical_hyperparameters_64)
+                return _decode_column(self, 'categorical_hyperparameters_64', pairs=True)
 
             @categoricals.setter
             def categoricals(self, value):
-                self.categorical_hyperparameters_64 = object_to_base_64(value)
+                self.categorical_hyperparameters_64 = object_to_json(value)
 
             @property
             def tunables(self):
@@ -358,19 +440,19 @@ class Database(object):
                 A list of parameters which are unspecified and must be selected
                 with a Tuner. Each element is a ('name', HyperParameter) tuple.
                 """
-                return base_64_to_object(self.tunable_hyperparameters_64)
+                return _decode_column(self, 'tunable_hyperparameters_64', pairs=True)
 
             @tunables.setter
             def tunables(self, value):
-                self.tunable_hyperparameters_64 = object_to_base_64(value)
+                self.tunable_hyperparameters_64 = object_to_json(value)
 
             @property
             def constants(self):
-                return base_64_to_object(self.constant_hyperparameters_64)
+                return _decode_column(self, 'constant_hyperparameters_64', pairs=True)
 
             @constants.setter
             def constants(self, value):
-                self.constant_hyperparameters_64 = object_to_base_64(value)
+                self.constant_hyperparameters_64 = object_to_json(value)
 
             def __repr__(self):
                 return "<%s: %s>" % (self.method, self.categoricals)
@@ -381,6 +463,11 @@ class Database(object):
 
         class Classifier(Base):
             __tablename__ = 'classifiers'
+            __table_args__ = (
+                Index('ix_classifiers_datarun_id_status', 'datarun_id', 'status'),
+                Index('ix_classifiers_hyperpartition_id_status', 'hyperpartition_id', 'status'),
+                Index('ix_classifiers_parent_id', 'parent_id'),
+            )
 
             # relational columns
             id = Column(Integer, primary_key=True, autoincrement=True)
@@ -397,14 +484,27 @@ class Database(object):
             model_location = Column(String(300))
             metrics_location = Column(String(300))
 
-            # base 64 encoding of the hyperparameter names and values
-            hyperparameter_values_64 = Column(Text, nullable=False)
+            # JSON encoding of the hyperparameter names and values (base 64 pickle
+            # in old rows). It is only loaded when accessed, or by the queries that
+            # return full classifiers.
+            hyperparameter_values_64 = deferred(Column(Text, nullable=False))
 
             # performance metrics
             cv_judgment_metric = Column(Numeric(precision=20, scale=10))
             cv_judgment_metric_stdev = Column(Numeric(precision=20, scale=10))
             test_judgment_metric = Column(Numeric(precision=20, scale=10))
 
+            # number of cross-validation folds scored, fewer than usual if it was
+            # stopped early
+            cv_folds = Column(Integer)
+
+            # in a multi-fidelity search, the classifier was trained on a proportion
+            # 1 / FIDELITY_ETA ** fidelity_level of the training data. 0 or NULL
+            # means all of it. parent_id is the classifier with the same
+            # hyperparameters that was promoted from the previous level.
+            fidelity_level = Column(Integer)
+            parent_id = Column(Integer, ForeignKey('classifiers.id'))
+
             start_time = Column(DateTime)
             end_time = Column(DateTime)
             status = Column(Enum(*CLASSIFIER_STATUS), nullable=False)
@@ -412,11 +512,11 @@ class Database(object):
 
             @property
             def hyperparameter_values(self):
-                return base_64_to_object(self.hyperparameter_values_64)
+                return _decode_column(self, 'hyperparameter_values_64')
 
             @hyperparameter_values.setter
             def hyperparameter_values(self, value):
-                self.hyperparameter_values_64 = object_to_base_64(value)
+                self.hyperparameter_values_64 = object_to_json(value)
 
             @property
             def mu_sigma_judgment_metric(self):
@@ -506,53 +606,112 @@ class Database(object):
         self.Classifier = Classifier
 
         Base.metadata.create_all(bind=self.engine)
+        self._upgrade_schema(metadata)
+
+    def _upgrade_schema(self, metadata):
+        """
+        Add to the existing tables the columns and indexes that have been added
+        to the schema after they were created.
+
+        New columns are added as nullable and without server default, so the
+        existing rows get NULL values.
+
+        Several workers may start at the same time on an old database, so a
+        column or index that fails to be added is ignored if another process
+        added it in the meantime.
+        """
+        inspector = inspect(self.engine)
+        preparer = self.engine.dialect.identifier_preparer
+        for table in metadata.sorted_tables:
+            columns = set(c['name'] for c in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in columns:
+                    column_type = column.type.compile(dialect=self.engine.dialect)
+                    try:
+                        self.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                            preparer.format_table(table), preparer.quote(column.name),
+                            column_type))
+                    except DBAPIError:
+                        # another process may have added it in the meantime
+                        added = inspect(self.engine).get_columns(table.name)
+                        if column.name not in set(c['name'] for c in added):
+                            raise
+
+            indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    try:
+                        index.create(bind=self.engine)
+                    except DBAPIError:
+                        added = inspect(self.engine).get_indexes(table.name)
+                        if index.name not in set(i['name'] for i in added):
+                            raise
 
     # ##########################################################################
     # #  Save/load the database  ###############################################
     # ##########################################################################
 
     @try_with_session()
-    def to_csv(self, path):
+    def to_csv(self, path, chunksize=CSV_CHUNKSIZE):
         """
         Save the entire ModelHub database as a set of CSVs in the given
         directory.
+
+        Tables are streamed and written ``chunksize`` rows at a time, so they
+        never need to fit in memory.
         """
-        for table in ['datasets', 'dataruns', 'hyperpartitions', 'classifiers']:
-            df = pd.read_sql('SELECT * FROM %s' % table, self.session.bind)
-            df.to_csv(os.path.join(path, '%s.csv' % table), index=False)
+        connection = self.session.connection().execution_options(stream_results=True)
+        for model in [self.Dataset, self.Datarun, self.Hyperpartition, self.Classifier]:
+            table = model.__tablename__
+            csv_path = os.path.join(path, '%s.csv' % table)
+            chunks = pd.read_sql('SELECT * FROM %s' % table, connection, chunksize=chunksize)
+
+            header = True
+            for df in chunks:
+                df.to_csv(csv_path, index=False, header=header, mode='w' if header else 'a')
+                header = False
+
+            if header:
+                # empty table: write only the header
+                columns = [c.name for c in model.__table__.columns]
+                pd.DataFrame(columns=columns).to_csv(csv_path, index=False)
 
     @try_with_session(commit=True)
-    def from_csv(self, path):
+    def from_csv(self, path, chunksize=CSV_CHUNKSIZE):
         """
         Load a snapshot of the ModelHub database from a set of CSVs in the given
         directory.
+
+        The CSVs are read ``chunksize`` rows at a time and each chunk is inserted
+        with a single executemany, all within one transaction.
         """
         for model, table in [(self.Dataset, 'dataset'),
                              (self.Datarun, 'datarun'),
                              (self.Hyperpartition, 'hyperpartition'),
                              (self.Classifier, 'classifier')]:
-            df = pd.read_csv(os.path.join(path, '%ss.csv' % table))
-
-            # parse datetime columns. This is necessary because SQLAlchemy can't
-            # interpret strings as datetimes on its own.
-            # yes, this is the easiest way to do it
-            for c in inspect(model).attrs:
-                if not isinstance(c, ColumnProperty):
+            columns = [c for c in inspect(model).attrs if isinstance(c, ColumnProperty)]
+            datetimes = [c.key for c in columns if isinstance(c.columns[0].type, DateTime)]
+            keys = set(c.key for c in columns)
+
+            csv_path = os.path.join(path, '%ss.csv' % table)
+            for df in pd.read_csv(csv_path, chunksize=chunksize):
+                # the CSV of an empty table has a single empty chunk, and inserting
+                # no rows would insert one row of default values instead
+                if not len(df):
                     continue
-                col = c.columns[0]
-                if isinstance(col.type, DateTime):
-                    df[c.key] = pd.to_datetime(df[c.key],
-                                               infer_datetime_format=True)
 
-            for _, r in df.iterrows():
-                # replace NaN and NaT with None
-                for k, v in list(r.iteritems()):
-                    if pd.isnull(v):
-                        r[k] = None
+                # parse datetime columns. This is necessary because SQLAlchemy can't
+                # interpret strings as datetimes on its own.
+                for key in datetimes:
+                    if key in df:
+                        df[key] = pd.to_datetime(df[key], infer_datetime_format=True)
+
+                # drop unknown columns, and replace NaN and NaT with None
+                df = df[[column for column in df.columns if column in keys]]
+                df = df.astype(object).where(pd.notnull(df), None)
 
-                # insert the row into the database
-                create_func = getattr(self, 'create_%s' % table)
-                create_func(**r)
+                # insert the rows into the database
+                self.session.execute(model.__table__.insert(), df.to_dict('records'))
 
     # ##########################################################################
     # #  Standard query methods  ###############################################
@@ -639,12 +798,23 @@ class Database(object):
     @try_with_session()
     def get_classifier(self, classifier_id):
         """ Get a specific classifier. """
-        return self.session.query(self.Classifier).get(classifier_id)
+        return self.session.query(self.Classifier)\
+            .options(undefer('hyperparameter_values_64')).get(classifier_id)
 
-    @try_with_session()
-    def get_classifiers(self, dataset_id=None, datarun_id=None, method=None,
-                        hyperpartition_id=None, status=None):
-        """ Get a set of classifiers, filtered by the passed-in arguments. """
+    def _get_column(self, column):
+        """
+        Get a column of the classifiers table by name. The mu_sigma judgment
+        metric is not stored, so it is computed from the cross-validation scores.
+        """
+        if column == 'mu_sigma_judgment_metric':
+            classifier = self.Classifier
+            return classifier.cv_judgment_metric - 2 * classifier.cv_judgment_metric_stdev
+
+        return getattr(self.Classifier, column)
+
+    def _get_classifiers_query(self, dataset_id=None, datarun_id=None, method=None,
+                               hyperpartition_id=None, status=None, min_id=None,
+                               extra_ids=None):
         query = self.session.query(self.Classifier)
         if dataset_id is not None:
             query = query.join(self.Datarun)\
@@ -658,8 +828,70 @@ class Database(object):
             query = query.filter(self.Classifier.hyperpartition_id == hyperpartition_id)
         if status is not None:
             query = query.filter(self.Classifier.status == status)
+        if min_id is not None:
+            query = query.filter(self._get_min_id_filter(min_id, extra_ids))
 
-        return query.all()
+        return query
+
+    def _get_min_id_filter(self, min_id, extra_ids=None):
+        """
+        Filter the classifiers from ``min_id`` on, plus the ones in ``extra_ids``,
+        which is used to check again some earlier classifiers.
+        """
+        min_id_filter = self.Classifier.id >= min_id
+        if extra_ids:
+            min_id_filter = or_(min_id_filter, self.Classifier.id.in_(extra_ids))
+
+        return min_id_filter
+
+    @try_with_session()
+    def get_classifiers(self, dataset_id=None, datarun_id=None, method=None,
+                        hyperpartition_id=None, status=None, min_id=None, extra_ids=None):
+        """ Get a set of classifiers, filtered by the passed-in arguments. """
+        query = self._get_classifiers_query(dataset_id, datarun_id, method,
+                                            hyperpartition_id, status, min_id, extra_ids)
+        return query.options(undefer('hyperparameter_values_64')).all()
+
+    @try_with_session()
+    def get_classifiers_values(self, columns, dataset_id=None, datarun_id=None, method=None,
+                               hyperpartition_id=None, status=None, min_id=None):
+        """
+        Get only the values of the given columns for a set of classifiers,
+        filtered by the passed-in arguments, as a list of tuples.
+        """
+        query = self._get_classifiers_query(dataset_id, datarun_id, method,
+                                            hyperpartition_id, status, min_id)
+        columns = [self._get_column(column) for column in columns]
+        return query.with_entities(*columns).all()
+
+    @try_with_session()
+    def count_classifiers(self, dataset_id=None, datarun_id=None, method=None,
+                          hyperpartition_id=None, status=None, min_id=None):
+        """
+        Count the classifiers that match the passed-in arguments, without
+        loading them.
+        """
+        query = self._get_classifiers_query(dataset_id, datarun_id, method,
+                                            hyperpartition_id, status, min_id)
+        return query.with_entities(func.count(self.Classifier.id)).scalar()
+
+    @try_with_session()
+    def get_classifier_scores(self, datarun_id, score_target, min_id=None, extra_ids=None):
+        """
+        Get the id, hyperpartition id, status and score_target value of the
+        classifiers of a datarun, ordered by id, without loading the full
+        classifier objects. If ``min_id`` is given, only the classifiers from
+        it on and the ones in ``extra_ids`` are returned.
+        """
+        query = self.session.query(self.Classifier.id,
+                                   self.Classifier.hyperpartition_id,
+                                   self.Classifier.status,
+                                   self._get_column(score_target))\
+            .filter(self.Classifier.datarun_id == datarun_id)
+        if min_id is not None:
+            query = query.filter(self._get_min_id_filter(min_id, extra_ids))
+
+        return query.order_by(self.Classifier.id).all()
 
     # ##########################################################################
     # #  Special-purpose queries  ##############################################
@@ -686,10 +918,8 @@ class Database(object):
         Get the number of classifiers that have errored using a specified
         hyperpartition.
         """
-        classifiers = self.session.query(self.Classifier)\
-            .filter(and_(self.Classifier.hyperpartition_id == hyperpartition_id,
-                         self.Classifier.status == ClassifierStatus.ERRORED)).all()
-        return len(classifiers)
+        return self.count_classifiers(hyperpartition_id=hyperpartition_id,
+                                      status=ClassifierStatus.ERRORED)
 
     @try_with_session()
     def get_methods(self, dataset_id=None, datarun_id=None,
@@ -715,25 +945,74 @@ class Database(object):
     @try_with_session()
     def get_best_classifier(self, score_target, dataset_id=None,
                             datarun_id=None, method=None,
-                            hyperpartition_id=None):
+                            hyperpartition_id=None, cached=False):
         """
         Get the classifier with the best judgment metric, as indicated by
         score_target.
 
         score_target: indicates the metric by which to judge the best classifier.
+            Only the classifiers trained on all the training data and fully
+            cross-validated are considered.
+        cached: if True, and only datarun_id is given, keep the result in memory
+            and update it whenever a classifier of the datarun is completed
+            through this Database instance. Classifiers completed by other
+            processes are not seen until the cache is dropped.
         """
-        classifiers = self.get_classifiers(dataset_id=dataset_id,
-                                           datarun_id=datarun_id,
-                                           method=method,
-                                           hyperpartition_id=hyperpartition_id,
-                                           status=ClassifierStatus.COMPLETE)
-
         if '_judgment_metric' not in score_target:
             score_target += '_judgment_metric'
 
-        if not classifiers:
+        cache_key = (datarun_id, score_target)
+        use_cache = cached and not (dataset_id or method or hyperpartition_id)
+        if use_cache and cache_key in self._best_classifiers:
+            return self._best_classifiers[cache_key]
+
+        score = self._get_column(score_target)
+        query = self._get_classifiers_query(dataset_id=dataset_id,
+                                            datarun_id=datarun_id,
+                                            method=method,
+                                            hyperpartition_id=hyperpartition_id,
+                                            status=ClassifierStatus.COMPLETE)
+
+        full_fidelity = or_(self.Classifier.fidelity_level.is_(None),
+                            self.Classifier.fidelity_level == 0)
+        full_cv = or_(self.Classifier.cv_folds.is_(None),
+                      self.Classifier.cv_folds >= Model.N_FOLDS)
+        best = query.filter(score.isnot(None), full_fidelity, full_cv)\
+            .options(undefer('hyperparameter_values_64'))\
+            .order_by(score.desc(), self.Classifier.id).first()
+
+        if use_cache:
+            self._best_classifiers[cache_key] = best
+
+        return best
+
+    @try_with_session()
+    def get_classifier_to_promote(self, datarun_id, score_target, fidelity_level):
+        """
+        Get the ID of a classifier to promote in a multi-fidelity search: the
+        best one among the best 1 / FIDELITY_ETA of the classifiers completed
+        at the given fidelity level that has not been promoted yet.
+        Returns None if all of them have been promoted.
+        """
+        score = self._get_column(score_target)
+        query = self._get_classifiers_query(datarun_id=datarun_id,
+                                            status=ClassifierStatus.COMPLETE)\
+            .filter(self.Classifier.fidelity_level == fidelity_level, score.isnot(None))
+
+        count = query.with_entities(func.count(self.Classifier.id)).scalar()
+        if count < FIDELITY_ETA:
             return None
-        return max(classifiers, key=attrgetter(score_target))
+
+        top = query.with_entities(self.Classifier.id.label('id'), score.label('score'))\
+            .order_by(score.desc(), self.Classifier.id.desc())\
+            .limit(count // FIDELITY_ETA).subquery()
+
+        child = aliased(self.Classifier)
+        promoted = exists().where(child.parent_id == top.c.id)
+        row = self.session.query(top.c.id).filter(~promoted)\
+            .order_by(top.c.score.desc(), top.c.id.desc()).first()
+
+        return row and row[0]
 
     @try_with_session()
     def load_model(self, classifier_id):
@@ -763,6 +1042,32 @@ class Database(object):
         self.session.add(datarun)
         return datarun
 
+    @try_with_session(commit=True)
+    def create_dataruns(self, dataruns, hyperpartitions):
+        """
+        Create several dataruns and their hyperpartitions in a single transaction,
+        inserting the hyperpartitions in bulk.
+
+        dataruns: list of dicts with the arguments of each datarun.
+        hyperpartitions: list with one list per datarun, containing dicts with
+            the arguments of each of its hyperpartitions, except the datarun_id.
+        Returns: the list of created dataruns.
+        """
+        dataruns = [self.Datarun(**kwargs) for kwargs in dataruns]
+        self.session.add_all(dataruns)
+
+        # assign the ids of the dataruns before creating their hyperpartitions
+        self.session.flush()
+
+        partitions = [
+            self.Hyperpartition(datarun_id=datarun.id, **kwargs)
+            for datarun, datarun_partitions in zip(dataruns, hyperpartitions)
+            for kwargs in datarun_partitions
+        ]
+        self.session.bulk_save_objects(partitions)
+
+        return dataruns
+
     @try_with_session(commit=True)
     def create_hyperpartition(self, **kwargs):
         partition = self.Hyperpartition(**kwargs)
@@ -777,7 +1082,7 @@ class Database(object):
 
     @try_with_session(commit=True)
     def start_classifier(self, hyperpartition_id, datarun_id, host,
-                         hyperparameter_values):
+                         hyperparameter_values, fidelity_level=None, parent_id=None):
         """
         Save a new, fully qualified classifier object to the database.
         Returns: the ID of the newly-created classifier
@@ -786,6 +1091,8 @@ class Database(object):
                                      datarun_id=datarun_id,
                                      host=host,
                                      hyperparameter_values=hyperparameter_values,
+                                     fidelity_level=fidelity_level,
+                                     parent_id=parent_id,
                                      start_time=datetime.now(),
                                      status=ClassifierStatus.RUNNING)
         self.session.add(classifier)
@@ -793,21 +1100,35 @@ class Database(object):
 
     @try_with_session(commit=True)
     def complete_classifier(self, classifier_id, model_location,
-                            metrics_location, cv_score, cv_stdev, test_score):
+                            metrics_location, cv_score, cv_stdev, test_score, cv_folds=None):
         """
         Set all the parameters on a classifier that haven't yet been set, and mark
         it as complete.
         """
-        classifier = self.session.query(self.Classifier).get(classifier_id)
+        classifier = self.get_classifier(classifier_id)
 
         classifier.model_location = model_location
         classifier.metrics_location = metrics_location
         classifier.cv_judgment_metric = cv_score
         classifier.cv_judgment_metric_stdev = cv_stdev
         classifier.test_judgment_metric = test_score
+        classifier.cv_folds = cv_folds
         classifier.end_time = datetime.now()
         classifier.status = ClassifierStatus.COMPLETE
 
+        # keep the cached best classifiers of this datarun up to date
+        stopped_early = cv_folds is not None and cv_folds < Model.N_FOLDS
+        if classifier.fidelity_level or stopped_early:
+            return
+
+        for (datarun_id, score_target), best in list(self._best_classifiers.items()):
+            score = getattr(classifier, score_target)
+            if datarun_id != classifier.datarun_id or score is None:
+                continue
+
+            if best is None or score > getattr(best, score_target):
+                self._best_classifiers[(datarun_id, score_target)] = classifier
+
     @try_with_session(commit=True)
     def mark_classifier_errored(self, classifier_id, error_message):
         """
@@ -853,6 +1174,59 @@ class Database(object):
             datarun.status = RunStatus.RUNNING
             datarun.start_time = datetime.now()
 
+    @try_with_session(commit=True)
+    def claim_datarun(self, include_ids=None, by_id=False):
+        """
+        Atomically claim the next datarun to work on, mark it as running and
+        return it. Returns None if there are no unfinished dataruns.
+
+        Among the unfinished dataruns with the highest priority, the one claimed
+        the longest time ago is chosen, so that concurrent workers spread over
+        them. If by_id is True, the one with the lowest id is chosen instead.
+
+        Args:
+            include_ids: only claim dataruns with ids from this list
+            by_id: claim the dataruns in sequential order, by id.
+        """
+        query = self.session.query(self.Datarun)\
+            .filter(self.Datarun.status != RunStatus.COMPLETE)
+        if include_ids:
+            query = query.filter(self.Datarun.id.in_(include_ids))
+
+        if by_id:
+            query = query.order_by(self.Datarun.priority.desc(), self.Datarun.id)
+        else:
+            query = query.order_by(self.Datarun.priority.desc(),
+                                   self.Datarun.claimed_at,
+                                   self.Datarun.id)
+
+        if self.engine.dialect.name == 'sqlite':
+            candidates = query.all()
+        else:
+            # lock the claimed row, and let other workers skip it instead of
+            # waiting for this transaction to finish
+            candidates = query.with_for_update(skip_locked=True).limit(1).all()
+
+        now = datetime.now()
+        for datarun in candidates:
+            # compare-and-set, so that a datarun can only be claimed once even
+            # on databases without row locks, like SQLite. If another worker
+            # claimed it in the meantime, try the next one.
+            claimed = self.session.query(self.Datarun)\
+                .filter(self.Datarun.id == datarun.id,
+                        self.Datarun.claimed_at == datarun.claimed_at)\
+                .update({'claimed_at': now}, synchronize_session=False)
+
+            if claimed:
+                datarun.claimed_at = now
+                if datarun.status == RunStatus.PENDING:
+                    datarun.status = RunStatus.RUNNING
+                    datarun.start_time = now
+
+                return datarun
+
+        return None
+
     @try_with_session(commit=True)
     def mark_datarun_complete(self, datarun_id):
         """
@@ -1,12 +1,15 @@
 from __future__ import absolute_import, division, unicode_literals
 
 from builtins import range
+from multiprocessing import cpu_count
 
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
+from scipy.sparse import csr_matrix
+from sklearn.base import clone
 from sklearn.metrics import (
-    accuracy_score, average_precision_score, cohen_kappa_score, f1_score, matthews_corrcoef,
-    precision_recall_curve, roc_auc_score, roc_curve)
+    average_precision_score, precision_recall_curve, roc_auc_score, roc_curve)
 from sklearn.model_selection import StratifiedKFold
 
 from atm.constants import METRICS_BINARY, METRICS_MULTICLASS, N_FOLDS_DEFAULT, Metrics
@@ -25,96 +28,199 @@ def rank_n_accuracy(y_true, y_prob_mat, n=0.33):
         # round to nearest int before casting
         n = int(round(n_classes * n))
 
-    # sort the rankings in descending order, then take the top n
-    rankings = np.argsort(-y_prob_mat)
-    rankings = rankings[:, :n]
+    n = min(n, n_classes)
+    if n <= 0 or not len(y_true):
+        return 0.0
 
-    num_samples = len(y_true)
-    correct_sample_count = 0.0   # force floating point math
+    # take the top n classes of each example, in no particular order
+    rankings = np.argpartition(-y_prob_mat, n - 1, axis=1)[:, :n]
 
-    for i in range(num_samples):
-        if y_true[i] in rankings[i, :]:
-            correct_sample_count += 1
+    correct = (rankings == np.asarray(y_true)[:, np.newaxis]).any(axis=1)
+    return float(correct.mean())
 
-    return int(correct_sample_count / num_samples)
 
-
-def get_per_class_matrix(y, classes=None):
+def get_per_class_matrix(y, classes=None, sparse=False):
     """
-    Create a (num_classes x num_examples) binary matrix representation of the
-    true and predicted y values.
+    Create a (num_examples x num_classes) binary matrix representation of the
+    true and predicted y values, as uint8.
     If classes is None, class values will be extracted from y. Values that are
     not present at all will not receive a column -- this is to allow computation
     of per-class roc_auc scores without error.
+    If sparse is True, return a scipy CSR matrix instead, which is much
+    smaller when there are many classes.
     """
-    classes = classes or np.unique(y)
-    y_bin = np.zeros((len(y), len(classes)))
-    for i, cls in enumerate(classes):
-        y_bin[:, i] = (y == cls).astype(int)
+    y = np.asarray(y)
+    classes = np.unique(y) if classes is None else np.asarray(classes)
+
+    # find the column of each example, and drop the examples of unknown classes
+    rows = np.arange(len(y))
+    columns = np.zeros(len(y), dtype=int)
+    if len(classes):
+        order = np.argsort(classes)
+        positions = np.searchsorted(classes, y, sorter=order).clip(max=len(classes) - 1)
+        columns = order[positions]
+        known = classes[columns] == y
+        rows, columns = rows[known], columns[known]
+
+    shape = (len(y), len(classes))
+    if sparse:
+        data = np.ones(len(rows), dtype=np.uint8)
+        return csr_matrix((data, (rows, columns)), shape=shape)
+
+    y_bin = np.zeros(shape, dtype=np.uint8)
+    y_bin[rows, columns] = 1
     return y_bin
 
 
-def get_pr_roc_curves(y_true, y_pred_probs):
+def _sample_curve_points(n_points, curve_points=None):
+    """
+    Choose the indices of at most curve_points points of a curve with n_points,
+    evenly spaced and always including both ends. If curve_points is None,
+    all of them are chosen.
+    """
+    if curve_points is None or n_points <= curve_points:
+        return np.arange(n_points)
+
+    return np.unique(np.linspace(0, n_points - 1, max(curve_points, 2)).round().astype(int))
+
+
+def get_pr_roc_curves(y_true, y_pred_probs, curve_points=None):
     """
     Compute precision/recall and receiver operating characteristic metrics for a
     binary class label.
 
     y_true: series of true class labels (only 1 or 0)
     y_pred_probs: series of probabilities generated by the model for the label class 1
+    curve_points: if given, keep at most this number of points of each curve,
+        sampled evenly along its thresholds, instead of one per distinct
+        probability.
     """
     results = {}
-    roc = roc_curve(y_true, y_pred_probs, pos_label=1)
+    fprs, tprs, thresholds = roc_curve(y_true, y_pred_probs, pos_label=1)
+    index = _sample_curve_points(len(thresholds), curve_points)
     results[Metrics.ROC_CURVE] = {
-        'fprs': list(roc[0]),
-        'tprs': list(roc[1]),
-        'thresholds': list(roc[2]),
+        'fprs': fprs[index].tolist(),
+        'tprs': tprs[index].tolist(),
+        'thresholds': thresholds[index].tolist(),
     }
 
-    pr = precision_recall_curve(y_true, y_pred_probs, pos_label=1)
+    # the last point of the PR curve has no threshold
+    precisions, recalls, thresholds = precision_recall_curve(y_true, y_pred_probs, pos_label=1)
+    index = _sample_curve_points(len(precisions), curve_points)
     results[Metrics.PR_CURVE] = {
-        'precisions': list(pr[0]),
-        'recalls': list(pr[1]),
-        'thresholds': list(pr[2]),
+        'precisions': precisions[index].tolist(),
+        'recalls': recalls[index].tolist(),
+        'thresholds': thresholds[index[index < len(thresholds)]].tolist(),
     }
 
     return results
 
 
-def get_metrics_binary(y_true, y_pred, y_pred_probs, include_curves=False):
+def _confusion_matrix(y_true, y_pred, n_classes):
+    """
+    Count the examples of each pair of true and predicted classes in a
+    (n_classes x n_classes) matrix, with the true classes as rows.
+    """
+    y_true = np.asarray(y_true, dtype=int)
+    y_pred = np.asarray(y_pred, dtype=int)
+    counts = np.bincount(y_true * n_classes + y_pred, minlength=n_classes ** 2)
+    return counts.reshape(n_classes, n_classes).astype(float)
+
+
+def _safe_divide(numerator, denominator, fill=0.0):
+    """Divide element-wise, using ``fill`` wherever the denominator is zero."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator == 0, fill, np.true_divide(numerator, denominator))
+
+
+def _get_binary_scores(tp, fp, fn, tn):
+    """
+    Compute the accuracy, Cohen's kappa, F1 and MCC scores of a binary label
+    from the counts of its confusion matrix. The counts can be arrays, to
+    score several labels at once.
+    """
+    n = tp + fp + fn + tn
+    pred_pos, pred_neg = tp + fp, fn + tn
+    true_pos, true_neg = tp + fn, fp + tn
+
+    accuracy = (tp + tn) / n
+    expected = (pred_pos * true_pos + pred_neg * true_neg) / n ** 2
+
+    return {
+        Metrics.ACCURACY: accuracy,
+        Metrics.COHEN_KAPPA: _safe_divide(accuracy - expected, 1 - expected, np.nan),
+        Metrics.F1: _safe_divide(2 * tp, 2 * tp + fp + fn),
+        Metrics.MCC: _safe_divide(tp * tn - fp * fn,
+                                  np.sqrt(pred_pos * true_pos * pred_neg * true_neg)),
+    }
+
+
+def _get_ranking_scores(y_true, y_score, include_curves=False, curve_points=None):
+    """
+    Compute the scores of a binary label that depend on how the examples are
+    ranked by ``y_score``, the probability (or distance) of class 1.
+    """
     results = {
-        Metrics.ACCURACY: accuracy_score(y_true, y_pred),
-        Metrics.COHEN_KAPPA: cohen_kappa_score(y_true, y_pred),
-        Metrics.F1: f1_score(y_true, y_pred),
-        Metrics.MCC: matthews_corrcoef(y_true, y_pred),
         Metrics.ROC_AUC: np.nan,
         Metrics.AP: np.nan,
     }
 
-    # if possible, compute PR and ROC curve metrics
-    all_labels_same = len(np.unique(y_true)) == 1
-    any_probs_nan = np.any(np.isnan(y_pred_probs))
-    if not any_probs_nan:
-        # AP can be computed even if all labels are the same
-        y_true_bin = get_per_class_matrix(y_true, list(range(2)))
-        results[Metrics.AP] = average_precision_score(y_true_bin, y_pred_probs)
+    if np.any(np.isnan(y_score)):
+        return results
+
+    # AP is averaged over both classes, and can be computed even if all labels
+    # are the same. Only the ranking matters, so -y_score ranks class 0.
+    y_true = np.asarray(y_true, dtype=int)
+    negative_ap = average_precision_score(1 - y_true, -y_score)
+    positive_ap = average_precision_score(y_true, y_score)
+    results[Metrics.AP] = (negative_ap + positive_ap) / 2
 
-        if not all_labels_same:
-            results[Metrics.ROC_AUC] = roc_auc_score(y_true_bin, y_pred_probs)
+    if len(np.unique(y_true)) > 1:
+        results[Metrics.ROC_AUC] = roc_auc_score(y_true, y_score)
 
-        # if necessary, compute point-by-point precision/recall and ROC curve data
-        if include_curves:
-            results.update(get_pr_roc_curves(y_true, y_pred_probs[:, 1]))
+    # if necessary, compute point-by-point precision/recall and ROC curve data
+    if include_curves:
+        results.update(get_pr_roc_curves(y_true, y_score, curve_points))
+
+    return results
+
+
+def get_metrics_binary(y_true, y_pred, y_pred_probs, include_curves=False, curve_points=None):
+    (tn, fp), (fn, tp) = _confusion_matrix(y_true, y_pred, 2)
+    scores = _get_binary_scores(tp, fp, fn, tn)
+
+    results = {metric: float(score) for metric, score in scores.items()}
+    results.update(_get_ranking_scores(y_true, y_pred_probs[:, 1], include_curves,
+                                       curve_points))
 
     return results
 
 
 def get_metrics_multiclass(y_true, y_pred, y_pred_probs,
-                           include_per_class=False, include_curves=False):
+                           include_per_class=False, include_curves=False, curve_points=None):
+    y_true = np.asarray(y_true)
+
+    # a single confusion matrix is enough for all the label-based metrics
+    n_classes = y_pred_probs.shape[1]
+    n_labels = max(n_classes, np.max(y_true) + 1, np.max(y_pred) + 1)
+    confusion = _confusion_matrix(y_true, y_pred, n_labels)
+
+    n = confusion.sum()
+    tp = np.diag(confusion)
+    pred = confusion.sum(axis=0)
+    true = confusion.sum(axis=1)
+
+    accuracy = tp.sum() / n
+    expected = np.dot(pred, true) / n ** 2
+    f1 = _safe_divide(2 * tp, pred + true)
+
     results = {
-        Metrics.ACCURACY: accuracy_score(y_true, y_pred),
-        Metrics.COHEN_KAPPA: cohen_kappa_score(y_true, y_pred),
-        Metrics.F1_MICRO: f1_score(y_true, y_pred, average='micro'),
-        Metrics.F1_MACRO: f1_score(y_true, y_pred, average='macro'),
+        Metrics.ACCURACY: float(accuracy),
+        Metrics.COHEN_KAPPA: float(_safe_divide(accuracy - expected, 1 - expected, np.nan)),
+        # with a single label per example, micro F1 is the same as the accuracy
+        Metrics.F1_MICRO: float(accuracy),
+        # the macro average only includes the classes that are true or predicted
+        Metrics.F1_MACRO: float(np.mean(f1[pred + true > 0])),
         Metrics.ROC_AUC_MICRO: np.nan,
         Metrics.ROC_AUC_MACRO: np.nan,
         Metrics.RANK_ACCURACY: np.nan,
@@ -151,20 +257,16 @@ def get_metrics_multiclass(y_true, y_pred, y_pred_probs,
     if include_per_class or include_curves:
         results['class_wise'] = {}
 
-        # create binary matrices, including classes that aren't actually present
-        all_classes = list(range(y_pred_probs.shape[1]))
-        y_true_bin = get_per_class_matrix(y_true, classes=all_classes)
-        y_pred_bin = get_per_class_matrix(y_pred, classes=all_classes)
-
-        # for each possible class, generate F1, precision-recall, and ROC scores
-        # using the binary metrics function.
-        for cls in all_classes:
-            class_pred_probs = np.column_stack((1 - y_pred_probs[:, cls],
-                                                y_pred_probs[:, cls]))
-            class_res = get_metrics_binary(y_true=y_true_bin[:, cls],
-                                           y_pred=y_pred_bin[:, cls],
-                                           y_pred_probs=class_pred_probs,
-                                           include_curves=include_curves)
+        # score every class against the rest at once, including the classes
+        # that aren't actually present
+        tp, pred, true = tp[:n_classes], pred[:n_classes], true[:n_classes]
+        class_scores = _get_binary_scores(tp, pred - tp, true - tp, n - pred - true + tp)
+
+        # the ranking metrics still need the probabilities of each class
+        for cls in range(n_classes):
+            class_res = {metric: float(scores[cls]) for metric, scores in class_scores.items()}
+            class_res.update(_get_ranking_scores(y_true == cls, y_pred_probs[:, cls],
+                                                 include_curves, curve_points))
             results['class_wise'][cls] = class_res
 
     return results
@@ -195,37 +297,86 @@ def test_pipeline(pipeline, X, y, binary, **kwargs):
     return get_metrics(y, y_pred, y_pred_probs, **kwargs)
 
 
-def cross_validate_pipeline(pipeline, X, y, binary=True,
-                            n_folds=N_FOLDS_DEFAULT, **kwargs):
+def _fit_and_test_fold(pipeline, X, y, train_index, test_index, binary, **kwargs):
+    """
+    Fit a clone of the pipeline on one cross-validation fold and compute its
+    metrics on the held out part of the fold.
+    """
+    pipeline = clone(pipeline)
+    pipeline.fit(X[train_index], y[train_index])
+    return test_pipeline(pipeline=pipeline,
+                         X=X[test_index],
+                         y=y[test_index],
+                         binary=binary, **kwargs)
+
+
+def cross_validate_pipeline(pipeline, X, y, binary=True, n_folds=N_FOLDS_DEFAULT, n_jobs=1,
+                            as_frame=False, stop_metric=None, stop_below=None, **kwargs):
     """
     Compute metrics for each of `n_folds` folds of the training data in (X, y).
 
-    pipeline: the sklearn Pipeline to train and test.
+    pipeline: the sklearn Pipeline to train and test. It is cloned for each
+        fold, so the given instance is left unfitted.
     X: feature matrix.
     y: series of labels corresponding to rows in X.
     binary: whether the label is binary or multi-ary.
     n_folds: number of non-overlapping "folds" of the data to make for cross-validation.
+    n_jobs: number of folds to fit in parallel processes. -1 means using all
+        the available cores.
+    as_frame: whether to return the fold scores as a pandas DataFrame instead
+        of a dict of arrays.
+    stop_metric: metric used to decide whether to stop early.
+    stop_below: if given, the folds are fitted in groups of n_jobs, and the
+        cross-validation stops as soon as the mean of stop_metric over the folds
+        fitted so far is below this value. The scores of the folds that are
+        not fitted are left as NaN.
+
+    Returns: the scores of each fold, as a dict mapping each metric name to an
+        array with one value per fold (or a DataFrame if as_frame is True),
+        and the list of full metrics dicts of each fitted fold.
     """
     if binary:
         metrics = METRICS_BINARY
     else:
         metrics = METRICS_MULTICLASS
 
-    df = pd.DataFrame(columns=metrics)
+    scores = {metric: np.full(n_folds, np.nan) for metric in metrics}
     results = []
 
     # TODO: how to handle classes that are so uncommon that stratified sampling
     # doesn't work? i.e. len([c for c in y if c == some_class]) < n_folds
     skf = StratifiedKFold(n_splits=n_folds)
     skf.get_n_splits(X, y)
+    splits = list(skf.split(X, y))
+
+    if stop_below is None:
+        group_size = n_folds
+    elif n_jobs < 0:
+        group_size = max(cpu_count() + 1 + n_jobs, 1)
+    else:
+        group_size = n_jobs
+
+    parallel = Parallel(n_jobs=n_jobs)
+    for start in range(0, n_folds, group_size):
+        folds = parallel(
+            delayed(_fit_and_test_fold)(pipeline, X, y, train_index, test_index, binary, **kwargs)
+            for train_index, test_index in splits[start:start + group_size]
+        )
+
+        for fold, split_results in enumerate(folds, start):
+            for metric in metrics:
+                value = split_results.get(metric)
+                if value is not None:
+                    scores[metric][fold] = value
+
+            results.append(split_results)
+
+        if stop_below is not None and len(results) < n_folds:
+            partial_score = np.mean(scores[stop_metric][:len(results)])
+            if partial_score < stop_below:
+                break
 
-    for train_index, test_index in skf.split(X, y):
-        pipeline.fit(X[train_index], y[train_index])
-        split_results = test_pipeline(pipeline=pipeline,
-                                      X=X[test_index],
-                                      y=y[test_index],
-                                      binary=binary, **kwargs)
-        df = df.append([{m: split_results.get(m) for m in metrics}])
-        results.append(split_results)
+    if as_frame:
+        scores = pd.DataFrame(scores, columns=metrics)
 
-    return df, results
+    return scores, results
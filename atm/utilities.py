@@ -9,6 +9,7 @@ import pickle
 from builtins import str
 
 import numpy as np
+from btb import HyperParameter
 
 from atm.compat import getargs
 
@@ -57,6 +58,52 @@ def base_64_to_object(b64str):
     return pickle.loads(decoded)
 
 
+def _json_default(obj):
+    if isinstance(obj, HyperParameter):
+        param_type = obj.param_type.name.lower()
+        return {'__hyperparameter__': {'type': param_type, 'range': obj._param_range}}
+
+    if isinstance(obj, np.generic):
+        return obj.item()
+
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+
+    raise TypeError('{} is not JSON serializable'.format(repr(obj)))
+
+
+def _json_object_hook(dictionary):
+    if '__hyperparameter__' in dictionary:
+        hyperparameter = dictionary['__hyperparameter__']
+        return HyperParameter(hyperparameter['type'], hyperparameter['range'])
+
+    return dictionary
+
+
+def object_to_json(obj):
+    """
+    Encode hyperparameter values, or lists of (name, value) tuples, as JSON.
+    Numpy values are converted to their python equivalents, and BTB
+    HyperParameters are stored as their type and range.
+    """
+    return json.dumps(obj, default=_json_default)
+
+
+def json_to_object(value):
+    """
+    Inverse of object_to_json. Values written by object_to_base_64 are
+    also accepted, so old database rows can still be read.
+    """
+    if isinstance(value, bytes):
+        value = value.decode('ascii')
+
+    # base64 strings never start with a bracket or a curly brace
+    if not value.startswith(('[', '{')):
+        return base_64_to_object(value)
+
+    return json.loads(value, object_hook=_json_object_hook)
+
+
 def obj_has_method(obj, method):
     """http://stackoverflow.com/questions/34439/finding-what-methods-an-object-has"""
     return hasattr(obj, method) and callable(getattr(obj, method))
@@ -1,22 +1,30 @@
 #!/usr/bin/python2.7
 from __future__ import absolute_import, unicode_literals
 
+import bisect
 import datetime
 import imp
 import logging
+import multiprocessing
 import os
 import re
 import socket
+import threading
+import time
 import traceback
 import warnings
-from builtins import object, str
+from builtins import object, range, str
 from collections import defaultdict
+from heapq import merge
+from itertools import chain
+from queue import Queue
 
 import boto3
 import numpy as np
+from boto3.s3.transfer import TransferConfig
 
-from atm.classifier import Model
-from atm.constants import CUSTOM_CLASS_REGEX, SELECTORS, TUNERS
+from atm.classifier import Model, load_encoded_data
+from atm.constants import CUSTOM_CLASS_REGEX, FIDELITY_ETA, SELECTORS, TUNERS
 from atm.database import ClassifierStatus, DBSession
 from atm.utilities import ensure_directory, get_instance, save_metrics, save_model, update_params
 
@@ -39,10 +47,140 @@ class ClassifierError(Exception):
     pass
 
 
+# Data shared by all the tasks of a process in the classifier pool. It is set
+# once per process by _init_pool, so the dataset is only sent to each process
+# once instead of with every classifier.
+_POOL_DATA = dict()
+
+
+def _init_pool(data, num_classes, num_features):
+    _POOL_DATA['data'] = data
+    _POOL_DATA['num_classes'] = num_classes
+    _POOL_DATA['num_features'] = num_features
+
+
+def _train_test_model(model):
+    metrics = model.train_test_encoded(_POOL_DATA['data'],
+                                       _POOL_DATA['num_classes'],
+                                       _POOL_DATA['num_features'])
+    return model, metrics
+
+
+class S3Uploader(object):
+    """
+    Upload files to an S3 bucket from a background thread.
+
+    A single client is reused for all the uploads. The boto3 transfer
+    manager sends large files as concurrent multipart uploads, and every
+    file is retried up to ``max_retries`` times before giving up on it.
+
+    Files are submitted in jobs, and the results of the finished jobs are
+    collected with ``get_finished``, so the thread that submitted them can
+    act on them.
+    """
+
+    # seconds to wait before the first retry, doubled after every failure
+    _RETRY_WAIT = 1
+
+    def __init__(self, bucket, client=None, access_key=None, secret_key=None,
+                 max_retries=3, transfer_config=None):
+        self.bucket = bucket
+        if client is None:
+            client = boto3.client(
+                's3',
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+            )
+
+        self.client = client
+        self.max_retries = max_retries
+        self.transfer_config = transfer_config or TransferConfig()
+
+        self._jobs = Queue()
+        self._finished = Queue()
+        self._pending = 0
+        self._thread = None
+
+    def upload(self, path, key):
+        """
+        Upload a file, retrying if it fails.
+        Returns: the S3 URL of the file.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.client.upload_file(path, self.bucket, key, Config=self.transfer_config)
+                return 's3://{}/{}'.format(self.bucket, key)
+
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+
+                wait = self._RETRY_WAIT * 2 ** attempt
+                LOGGER.warning('Error uploading %s to s3://%s/%s, retrying in %s seconds',
+                               path, self.bucket, key, wait)
+                time.sleep(wait)
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+
+            job_id, files = job
+            try:
+                urls = [
+                    None if path is None else self.upload(path, key)
+                    for path, key in files
+                ]
+                self._finished.put((job_id, urls, None))
+
+            except Exception:
+                self._finished.put((job_id, None, traceback.format_exc()))
+
+    def submit(self, job_id, files):
+        """
+        Upload a list of (path, key) pairs in the background. Pairs whose path
+        is None are skipped, and get None as their URL.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+        self._pending += 1
+        self._jobs.put((job_id, files))
+
+    def get_finished(self, wait=False):
+        """
+        Get the jobs that have finished since the last call, as a list of
+        (job_id, urls, error) tuples, where urls is None and error has the
+        traceback if any of the files could not be uploaded.
+        If ``wait`` is True, block until all the submitted jobs have finished.
+        """
+        finished = list()
+        while self._pending and (wait or not self._finished.empty()):
+            finished.append(self._finished.get())
+            self._pending -= 1
+
+        return finished
+
+    def close(self):
+        """Wait for the pending uploads and stop the background thread."""
+        if self._thread is not None:
+            self._jobs.put(None)
+            self._thread.join()
+            self._thread = None
+
+
 class Worker(object):
+
+    # seconds to wait between checks for finished classifiers in the pool
+    _POOL_WAIT = 0.1
+
     def __init__(self, database, datarun, save_files=True, cloud_mode=False,
                  aws_access_key=None, aws_secret_key=None, s3_bucket=None, s3_folder=None,
-                 models_dir='models', metrics_dir='metrics', verbose_metrics=False):
+                 models_dir='models', metrics_dir='metrics', verbose_metrics=False,
+                 tuner_batch_size=1, curve_points=None, s3_client=None):
 
         self.db = database
         self.datarun = datarun
@@ -54,15 +192,51 @@ class Worker(object):
         self.s3_bucket = s3_bucket
         self.s3_folder = s3_folder
 
+        # in cloud mode, the files of the classifiers are uploaded in the background
+        # and the classifiers are only completed once their upload has finished.
+        self.s3_client = s3_client
+        self._uploader = None
+        self._uploading = dict()
+
         self.models_dir = models_dir
         self.metrics_dir = metrics_dir
         self.verbose_metrics = verbose_metrics
+        self.curve_points = curve_points
         ensure_directory(self.models_dir)
         ensure_directory(self.metrics_dir)
 
         # load the Dataset from the database
         self.dataset = self.db.get_dataset(self.datarun.dataset_id)
 
+        # all the classifiers tested by this worker use the same train/test
+        # split, so the encoded data can be cached and reused between them.
+        self.random_state = np.random.randint(1e7)
+        self._data_cache = dict()
+
+        # process pool and classifiers being tested on it, by classifier id.
+        # Each process of the pool holds a copy of the encoded data.
+        self._pool = None
+        self._pool_nbytes = 0
+        self._pending = dict()
+
+        # hyperparameter proposals that have not been tested yet, by hyperpartition id.
+        # They are generated in batches of tuner_batch_size from a single tuner fit.
+        self.tuner_batch_size = tuner_batch_size
+        self._proposals = defaultdict(list)
+
+        # live tuners by hyperpartition id. Each one is stored together with the id
+        # of the last classifier already fetched for it and the ids of the fetched
+        # classifiers that were still running, which are fetched again until they
+        # finish. Running classifiers of crashed workers never finish, but they
+        # only cost this small set of ids and do not hold the watermark back.
+        self._tuners = dict()
+
+        # (id, score) pairs of the finished classifiers, by hyperpartition id, kept
+        # up to date for hyperpartition selection with the same kind of watermark.
+        self._scores = defaultdict(list)
+        self._scores_last_id = 0
+        self._scores_pending = set()
+
         # load the Selector and Tuner classes specified by our datarun
         self.load_selector()
         self.load_tuner()
@@ -124,30 +298,111 @@ class Worker(object):
         """
         hyperpartitions = self.db.get_hyperpartitions(datarun_id=self.datarun.id)
 
-        # load classifiers and build scores lists
-        # make sure all hyperpartitions are present in the dict, even ones that
-        # don't have any classifiers. That way the selector can choose hyperpartitions
-        # that haven't been scored yet.
-        hyperpartition_scores = {fs.id: [] for fs in hyperpartitions}
-        classifiers = self.db.get_classifiers(datarun_id=self.datarun.id)
-
-        for c in classifiers:
-            # ignore hyperpartitions for which gridding is done
-            if c.hyperpartition_id not in hyperpartition_scores:
-                continue
+        # fetch only the scores of the classifiers that may have changed since the
+        # last selection: the ones after the watermark and the ones still running.
+        rows = self.db.get_classifier_scores(self.datarun.id, self.datarun.score_target,
+                                             min_id=self._scores_last_id + 1,
+                                             extra_ids=self._scores_pending)
 
+        running = defaultdict(list)
+        for classifier_id, hyperpartition_id, status, score in rows:
             # the cast to float is necessary because the score is a Decimal;
             # doing Decimal-float arithmetic throws errors later on.
-            score = float(getattr(c, self.datarun.score_target) or 0)
-            hyperpartition_scores[c.hyperpartition_id].append(score)
+            score = float(score or 0)
+            if status == ClassifierStatus.RUNNING:
+                running[hyperpartition_id].append((classifier_id, score))
+            else:
+                bisect.insort(self._scores[hyperpartition_id], (classifier_id, score))
+
+        # classifiers that are still running may complete later, so they are
+        # fetched again in the next update.
+        self._scores_pending = set(c[0] for c in chain(*running.values()))
+        if rows:
+            self._scores_last_id = max(self._scores_last_id, rows[-1][0])
+
+        # build scores lists, in classifier order. Make sure all hyperpartitions are
+        # present in the dict, even ones that don't have any classifiers. That way the
+        # selector can choose hyperpartitions that haven't been scored yet.
+        # hyperpartitions for which gridding is done are ignored.
+        hyperpartition_scores = dict()
+        for hp in hyperpartitions:
+            scores = merge(self._scores[hp.id], running[hp.id])
+            hyperpartition_scores[hp.id] = [score for _, score in scores]
 
         hyperpartition_id = self.selector.select(hyperpartition_scores)
         return self.db.get_hyperpartition(hyperpartition_id)
 
+    def _propose(self, tuner):
+        """
+        Get a batch of tuner_batch_size proposals from an already fitted tuner,
+        dropping the duplicated ones. Returns None if the tuner has nothing
+        else to propose.
+        """
+        if self.tuner_batch_size == 1:
+            params = tuner.propose()
+            return None if params is None else [params]
+
+        proposals = tuner.propose(self.tuner_batch_size)
+        if proposals is None:
+            return None
+
+        if isinstance(proposals, dict):
+            proposals = [proposals]
+
+        unique = dict()
+        for params in proposals:
+            unique.setdefault(tuple(sorted(params.items())), params)
+
+        return list(unique.values())
+
+    def _get_tuner(self, hyperpartition):
+        """
+        Get the live tuner of a hyperpartition, creating it the first time, and
+        add to it only the classifiers completed since it was last updated.
+        """
+        if hyperpartition.id in self._tuners:
+            tuner, last_id, pending = self._tuners[hyperpartition.id]
+        else:
+            # this has to be initialized with information from the hyperpartition,
+            # so it cannot be done in load_tuner
+            tuner = get_instance(self.Tuner,
+                                 tunables=hyperpartition.tunables,
+                                 gridding=self.datarun.gridding,
+                                 r_minimum=self.datarun.r_minimum)
+            last_id, pending = 0, set()
+
+        classifiers = self.db.get_classifiers(hyperpartition_id=hyperpartition.id,
+                                              min_id=last_id + 1, extra_ids=pending)
+
+        # in a multi-fidelity search, the tuner only learns from the classifiers
+        # trained at the lowest fidelity, so all its scores are comparable.
+        base_level = self._get_base_fidelity_level()
+        new = [c for c in classifiers if c.status == ClassifierStatus.COMPLETE]
+        new = [c for c in new if c.fidelity_level == base_level]
+        if new:
+            X = [c.hyperparameter_values for c in new]
+            y = [float(getattr(c, self.datarun.score_target)) for c in new]
+            tuner.add(X, y)
+
+        # classifiers that are still running may complete later, so they are
+        # fetched again in the next update.
+        pending = set(c.id for c in classifiers if c.status == ClassifierStatus.RUNNING)
+        if classifiers:
+            last_id = max(last_id, max(c.id for c in classifiers))
+
+        self._tuners[hyperpartition.id] = (tuner, last_id, pending)
+
+        return tuner
+
     def tune_hyperparameters(self, hyperpartition):
         """
         Use the hyperparameter tuning method specified by our datarun to choose
         a set of hyperparameters from the potential space.
+
+        The tuner of each hyperpartition is kept alive between calls and only
+        fed the newly completed classifiers. It is asked for tuner_batch_size
+        proposals at once, and the ones that are not used right away are queued
+        for the next classifiers of the same hyperpartition.
         """
         # Get parameter metadata for this hyperpartition
         tunables = hyperpartition.tunables
@@ -157,55 +412,146 @@ class Worker(object):
         if not len(tunables):
             LOGGER.warning('No tunables for hyperpartition %d' % hyperpartition.id)
             self.db.mark_hyperpartition_gridding_done(hyperpartition.id)
-            return update_params(params=[],
-                                 tunables=tunables,
+            return update_params(params={},
                                  categoricals=hyperpartition.categoricals,
                                  constants=hyperpartition.constants)
 
-        # Get previously-used parameters: every classifier should either be
-        # completed or have thrown an error
-        all_clfs = self.db.get_classifiers(hyperpartition_id=hyperpartition.id)
-        classifiers = [c for c in all_clfs if c.status == ClassifierStatus.COMPLETE]
-
-        X = [c.hyperparameter_values for c in classifiers]
-        y = np.array([float(getattr(c, self.datarun.score_target)) for c in classifiers])
-
-        # Initialize the tuner and propose a new set of parameters
-        # this has to be initialized with information from the hyperpartition, so we
-        # need to do it fresh for each classifier (not in load_tuner)
-        tuner = get_instance(self.Tuner,
-                             tunables=tunables,
-                             gridding=self.datarun.gridding,
-                             r_minimum=self.datarun.r_minimum)
-        if len(X) > 0:
-            tuner.add(X, y)
+        proposals = self._proposals[hyperpartition.id]
+        if not proposals:
+            tuner = self._get_tuner(hyperpartition)
+            batch = self._propose(tuner)
+            if batch is None and self.datarun.gridding:
+                LOGGER.info('Gridding done for hyperpartition %d' % hyperpartition.id)
+                self.db.mark_hyperpartition_gridding_done(hyperpartition.id)
+                return None
 
-        params = tuner.propose()
-        if params is None and self.datarun.gridding:
-            LOGGER.info('Gridding done for hyperpartition %d' % hyperpartition.id)
-            self.db.mark_hyperpartition_gridding_done(hyperpartition.id)
-            return None
+            proposals.extend(batch)
+
+        params = proposals.pop(0)
 
         # Append categorical and constants to the params.
         return update_params(params=params,
                              categoricals=hyperpartition.categoricals,
                              constants=hyperpartition.constants)
 
-    def test_classifier(self, method, params):
+    def load_data(self, testing_ratio):
         """
-        Given a set of fully-qualified hyperparameters, create and test a
-        classifier model.
-        Returns: Model object and metrics dictionary
+        Load, split and encode the dataset of our datarun. The encoded data is
+        cached by dataset id, split seed and testing ratio, so only the first
+        classifier tested by this worker pays the cost of parsing and encoding.
+        Returns: tuple with the fitted encoder and the train and test arrays
+        """
+        key = (self.dataset.id, self.random_state, testing_ratio)
+        data = self._data_cache.get(key)
+        if data is None:
+            LOGGER.debug('Loading and encoding dataset %d' % self.dataset.id)
+            data = load_encoded_data(self.dataset, self.dataset.class_column,
+                                     testing_ratio, self.random_state)
+            self._data_cache[key] = data
+
+        return data
+
+    @staticmethod
+    def _get_nbytes(data):
+        nbytes = 0
+        for array in data[1:]:
+            # scipy sparse matrices keep their values in a data array
+            nbytes += getattr(array, 'nbytes', None) or array.data.nbytes
+
+        return nbytes
+
+    def data_nbytes(self):
+        """
+        Number of bytes used by the encoded data arrays cached by this worker,
+        including the copies held by the processes of its pool.
+        """
+        nbytes = sum(self._get_nbytes(data) for data in self._data_cache.values())
+        return nbytes + self._pool_nbytes
+
+    def _get_stop_threshold(self, hyperpartition_id, fidelity_level=None):
+        """
+        Get the cross-validation score below which the classifiers of a
+        hyperpartition are stopped early: the median score of its completed
+        classifiers at the same fidelity level, once there are at least
+        r_minimum of them.
+        Returns None if early stopping does not apply.
         """
-        model = Model(method=method, params=params,
-                      judgment_metric=self.datarun.metric,
-                      class_column=self.dataset.class_column,
-                      verbose_metrics=self.verbose_metrics)
+        if not self.datarun.early_stopping:
+            return None
+
+        # the test score is only known after training the final model, and the
+        # standard deviation of a partial cross-validation is meaningless, so
+        # only the plain cross-validation score can be used to stop early.
+        if self.datarun.score_target != 'cv_judgment_metric':
+            return None
+
+        rows = self.db.get_classifiers_values(['cv_judgment_metric', 'fidelity_level'],
+                                              hyperpartition_id=hyperpartition_id,
+                                              status=ClassifierStatus.COMPLETE)
+        scores = [float(score) for score, level in rows
+                  if score is not None and level == fidelity_level]
+        if len(scores) < max(self.datarun.r_minimum or 1, 1):
+            return None
+
+        return float(np.median(scores))
 
-        train_path, test_path = self.dataset.load()
+    def _get_base_fidelity_level(self):
+        """
+        Get the fidelity level at which new classifiers are trained in a
+        multi-fidelity search: the highest one whose proportion of the training
+        data, 1 / FIDELITY_ETA ** level, is not below the min_fidelity of the
+        datarun.
+        Returns None if the datarun is not a multi-fidelity search.
+        """
+        min_fidelity = self.datarun.min_fidelity
+        if not min_fidelity:
+            return None
 
-        metrics = model.train_test(self.dataset)
+        level = 0
+        while 1.0 / FIDELITY_ETA ** (level + 1) >= float(min_fidelity) - 1e-9:
+            level += 1
 
+        return level or None
+
+    def _get_promotion(self, base_level):
+        """
+        Find a classifier to promote in a multi-fidelity search: one of the best
+        1 / FIDELITY_ETA of the classifiers completed at a level that has not
+        been promoted yet, looking first at the levels closest to the full data.
+        Returns: tuple with the ID of the classifier and the fidelity level to
+            train it at next, or None if there is nothing to promote.
+        """
+        for level in range(1, base_level + 1):
+            classifier_id = self.db.get_classifier_to_promote(
+                self.datarun.id, self.datarun.score_target, level)
+            if classifier_id is not None:
+                return classifier_id, level - 1
+
+        return None
+
+    def _make_model(self, method, params, n_jobs=None, stop_below=None, fidelity_level=None):
+        if n_jobs is None:
+            n_jobs = self.datarun.n_jobs or 1
+
+        fidelity = None
+        if fidelity_level:
+            fidelity = 1.0 / FIDELITY_ETA ** fidelity_level
+
+        return Model(method=method, params=params,
+                     judgment_metric=self.datarun.metric,
+                     class_column=self.dataset.class_column,
+                     verbose_metrics=self.verbose_metrics,
+                     curve_points=self.curve_points,
+                     random_state=self.random_state,
+                     n_jobs=n_jobs,
+                     stop_below=stop_below,
+                     fidelity=fidelity)
+
+    def _log_scores(self, model):
+        """
+        Log the judgment metric of a tested model and compare it against the
+        best classifier of the datarun so far.
+        """
         target = self.datarun.score_target
 
         def metric_string(model):
@@ -220,7 +566,7 @@ class Worker(object):
                                                       metric_string(model)))
 
         old_best = self.db.get_best_classifier(datarun_id=self.datarun.id,
-                                               score_target=target)
+                                               score_target=target, cached=True)
         if old_best is not None:
             if getattr(model, target) > getattr(old_best, target):
                 LOGGER.info('New best score! Previous best (classifier %s): %s',
@@ -229,6 +575,22 @@ class Worker(object):
                 LOGGER.info('Best so far (classifier %s): %s',
                             old_best.id, metric_string(old_best))
 
+    def test_classifier(self, method, params, stop_below=None, fidelity_level=None):
+        """
+        Given a set of fully-qualified hyperparameters, create and test a
+        classifier model. If stop_below is given, the cross-validation stops
+        early when the model scores below it. If fidelity_level is given, the
+        model is trained on a subsample of the training data.
+        Returns: Model object and metrics dictionary
+        """
+        model = self._make_model(method, params, stop_below=stop_below,
+                                 fidelity_level=fidelity_level)
+
+        data = self.load_data(model.testing_ratio)
+        metrics = model.train_test(self.dataset, data)
+
+        self._log_scores(model)
+
         return model, metrics
 
     def save_classifier(self, classifier_id, model, metrics):
@@ -236,6 +598,10 @@ class Worker(object):
         Update a classifier with metrics and model information and mark it as
         "complete"
 
+        In cloud mode, the model and metrics are uploaded to S3 in the
+        background, and the classifier is only marked as "complete" by
+        collect_uploads once the upload has finished.
+
         classifier_id: ID of the classifier to save
 
         model: Model object containing a serializable representation of the
@@ -244,24 +610,37 @@ class Worker(object):
         metrics: Dictionary containing cross-validation and test metrics data
             for the model.
         """
+        scores = dict(
+            cv_score=model.cv_judgment_metric,
+            cv_stdev=model.cv_judgment_metric_stdev,
+            test_score=model.test_judgment_metric,
+            cv_folds=model.cv_folds
+        )
+
         # whether to save model and metrics data to the filesystem
         if self.save_files:
             # keep a database session open so that the utility functions can
             # access the linked hyperpartitions and dataruns
             with DBSession(self.db):
                 classifier = self.db.get_classifier(classifier_id)
-                model_path = save_model(classifier, self.models_dir, model)
+                if model.stopped_early:
+                    # the final model was not trained, so there is nothing to save
+                    model_path = None
+                else:
+                    model_path = save_model(classifier, self.models_dir, model)
+
                 metric_path = save_metrics(classifier, self.metrics_dir, metrics)
 
             # if necessary, save model and metrics to Amazon S3 bucket
             if self.cloud_mode:
-                try:
-                    model_path, metric_path = self.save_classifier_cloud(model_path, metric_path)
-
-                except Exception:
-                    msg = traceback.format_exc()
-                    LOGGER.error('Error in save_classifier_cloud()')
-                    self.db.mark_classifier_errored(classifier_id, error_message=msg)
+                files = [
+                    (model_path, self._get_s3_key(model_path)),
+                    (metric_path, self._get_s3_key(metric_path)),
+                ]
+                self._get_uploader().submit(classifier_id, files)
+                self._uploading[classifier_id] = scores
+                LOGGER.info('Uploading classifier %d to S3...' % classifier_id)
+                return
         else:
             model_path = None
             metric_path = None
@@ -270,13 +649,53 @@ class Worker(object):
         self.db.complete_classifier(classifier_id=classifier_id,
                                     model_location=model_path,
                                     metrics_location=metric_path,
-                                    cv_score=model.cv_judgment_metric,
-                                    cv_stdev=model.cv_judgment_metric_stdev,
-                                    test_score=model.test_judgment_metric)
+                                    **scores)
 
         # update this session's hyperpartition entry
         LOGGER.info('Saved classifier %d.' % classifier_id)
 
+    def _get_uploader(self):
+        if self._uploader is None:
+            self._uploader = S3Uploader(self.s3_bucket, client=self.s3_client,
+                                        access_key=self.aws_access_key,
+                                        secret_key=self.aws_secret_key)
+
+        return self._uploader
+
+    def _get_s3_key(self, local_path):
+        if local_path is None:
+            return None
+
+        if self.s3_folder:
+            return os.path.join(self.s3_folder, local_path)
+
+        return local_path
+
+    def collect_uploads(self, wait=False):
+        """
+        Complete the classifiers whose files have finished uploading to S3, or
+        mark them as errored if the upload failed.
+        If ``wait`` is True, block until all the pending uploads have finished.
+        """
+        if self._uploader is None:
+            return
+
+        for classifier_id, urls, error in self._uploader.get_finished(wait):
+            scores = self._uploading.pop(classifier_id)
+            if error is not None:
+                LOGGER.error('Error uploading classifier %d to S3' % classifier_id)
+                LOGGER.error(error)
+                self.db.mark_classifier_errored(classifier_id, error_message=error)
+                continue
+
+            model_url, metric_url = urls
+            self.db.complete_classifier(classifier_id=classifier_id,
+                                        model_location=model_url,
+                                        metrics_location=metric_url,
+                                        **scores)
+
+            LOGGER.info('Saved classifier %d.' % classifier_id)
+
     def save_classifier_cloud(self, local_model_path, local_metric_path, delete_local=False):
         """
         Save a classifier to the S3 bucket supplied on __init__. Saves a
@@ -286,38 +705,30 @@ class Worker(object):
         local_model_path: path to serialized model in the local file system
         local_metric_path: path to serialized metrics in the local file system
         """
+        uploader = self._get_uploader()
 
-        client = boto3.client(
-            's3',
-            aws_access_key_id=self.aws_access_key,
-            aws_secret_access_key=self.aws_secret_key,
-        )
-
-        if self.s3_folder:
-            aws_model_path = os.path.join(self.s3_folder, local_model_path)
-            aws_metric_path = os.path.join(self.s3_folder, local_metric_path)
-        else:
-            aws_model_path = local_model_path
-            aws_metric_path = local_metric_path
-
-        LOGGER.info('Uploading model at %s to s3://%s/%s',
-                    local_model_path, self.s3_bucket, aws_model_path)
-        client.upload_file(local_model_path, self.s3_bucket, aws_model_path)
+        # classifiers stopped early have no model file
+        model_url = None
+        if local_model_path is not None:
+            aws_model_path = self._get_s3_key(local_model_path)
+            LOGGER.info('Uploading model at %s to s3://%s/%s',
+                        local_model_path, self.s3_bucket, aws_model_path)
+            model_url = uploader.upload(local_model_path, aws_model_path)
 
+        aws_metric_path = self._get_s3_key(local_metric_path)
         LOGGER.info('Uploading metric at %s to s3://%s/%s',
                     local_metric_path, self.s3_bucket, aws_metric_path)
-        client.upload_file(local_metric_path, self.s3_bucket, aws_metric_path)
+        metric_url = uploader.upload(local_metric_path, aws_metric_path)
 
         if delete_local:
             LOGGER.info('Deleting local copies of %s and %s',
                         local_model_path, local_metric_path)
-            os.remove(local_model_path)
+            if local_model_path is not None:
+                os.remove(local_model_path)
+
             os.remove(local_metric_path)
 
-        return (
-            's3://{}/{}'.format(self.s3_bucket, aws_model_path),
-            's3://{}/{}'.format(self.s3_bucket, aws_metric_path)
-        )
+        return model_url, metric_url
 
     def is_datarun_finished(self):
         """
@@ -333,7 +744,7 @@ class Worker(object):
         if self.datarun.budget_type == 'classifier':
             # hyperpartition classifier counts are updated whenever a classifier
             # is created, so this will count running, errored, and complete.
-            n_completed = len(self.db.get_classifiers(datarun_id=self.datarun.id))
+            n_completed = self.db.count_classifiers(datarun_id=self.datarun.id)
             if n_completed >= self.datarun.budget:
                 LOGGER.warning('Classifier budget has run out!')
                 return True
@@ -346,17 +757,13 @@ class Worker(object):
 
         return False
 
-    def run_classifier(self, hyperpartition_id=None):
+    def _choose_hyperparameters(self, hyperpartition_id=None):
         """
-        Choose hyperparameters, then use them to test and save a Classifier.
+        Choose a hyperpartition, or use the given one, and then use the tuner
+        to choose a set of hyperparameters from it.
+        Returns: tuple with the hyperpartition and the chosen parameters, or
+            None if no parameters could be chosen.
         """
-        # check to see if our work is done
-        if self.is_datarun_finished():
-            # marked the run as done successfully
-            self.db.mark_datarun_complete(self.datarun.id)
-            LOGGER.warning('Datarun %d has ended.' % self.datarun.id)
-            return
-
         try:
             LOGGER.debug('Choosing hyperparameters...')
             if hyperpartition_id is not None:
@@ -364,7 +771,7 @@ class Worker(object):
                 if hyperpartition.datarun_id != self.datarun.id:
                     LOGGER.error('Hyperpartition %d is not a part of datarun %d'
                                  % (hyperpartition_id, self.datarun.id))
-                    return
+                    return None
             else:
                 # use the multi-arm bandit to choose which hyperpartition to use next
                 hyperpartition = self.select_hyperpartition()
@@ -380,7 +787,7 @@ class Worker(object):
         if params is None:
             LOGGER.warning('No parameters chosen: hyperpartition %d is finished.'
                            % hyperpartition.id)
-            return
+            return None
 
         param_info = 'Chose parameters for method "%s":' % hyperpartition.method
         for k in sorted(params.keys()):
@@ -388,21 +795,225 @@ class Worker(object):
 
         LOGGER.info(param_info)
 
-        LOGGER.debug('Creating classifier...')
-        classifier = self.db.start_classifier(hyperpartition_id=hyperpartition.id,
-                                              datarun_id=self.datarun.id,
-                                              host=HOSTNAME,
-                                              hyperparameter_values=params)
+        return hyperpartition, params
+
+    def _choose_classifier(self, hyperpartition_id=None):
+        """
+        Choose the hyperpartition, the hyperparameters and the fidelity level of
+        the next classifier. In a multi-fidelity search, the classifiers that
+        deserve a promotion are trained again on more data before new
+        hyperparameters are tried at the lowest fidelity.
+        Returns: tuple with the hyperpartition, the parameters, the fidelity
+            level and the ID of the promoted classifier, or None if no
+            parameters could be chosen.
+        """
+        base_level = self._get_base_fidelity_level()
+        if base_level is not None and hyperpartition_id is None:
+            promotion = self._get_promotion(base_level)
+            if promotion is not None:
+                parent_id, fidelity_level = promotion
+                parent = self.db.get_classifier(parent_id)
+                hyperpartition = self.db.get_hyperpartition(parent.hyperpartition_id)
+                LOGGER.info('Promoting classifier %d to fidelity level %d'
+                            % (parent_id, fidelity_level))
+                return hyperpartition, parent.hyperparameter_values, fidelity_level, parent_id
+
+        chosen = self._choose_hyperparameters(hyperpartition_id)
+        if chosen is None:
+            return None
+
+        hyperpartition, params = chosen
+        return hyperpartition, params, base_level, None
+
+    def run_classifier(self, hyperpartition_id=None):
+        """
+        Choose hyperparameters, then use them to test and save a Classifier.
+
+        The database operations before and after training the classifier share
+        a session each, but no session is held open while it is trained.
+        """
+        with DBSession(self.db):
+            started = self._start_classifier(hyperpartition_id)
+
+        if started is None:
+            return
 
+        classifier, hyperpartition, params, fidelity_level = started
         try:
+            stop_below = self._get_stop_threshold(hyperpartition.id, fidelity_level)
+
             LOGGER.debug('Testing classifier...')
-            model, metrics = self.test_classifier(hyperpartition.method, params)
+            model, metrics = self.test_classifier(hyperpartition.method, params, stop_below,
+                                                  fidelity_level)
             LOGGER.debug('Saving classifier...')
-            self.save_classifier(classifier.id, model, metrics)
+            with DBSession(self.db):
+                self.save_classifier(classifier.id, model, metrics)
 
         except Exception:
-            msg = traceback.format_exc()
-            LOGGER.error('Error testing classifier: datarun=%s' % str(self.datarun))
-            LOGGER.error(msg)
-            self.db.mark_classifier_errored(classifier.id, error_message=msg)
+            self._mark_classifier_errored(classifier.id)
             raise ClassifierError()
+
+    def _start_classifier(self, hyperpartition_id=None):
+        """
+        Choose the hyperparameters of the next classifier and save it as running.
+        Returns: tuple with the classifier, its hyperpartition, hyperparameters
+            and fidelity level, or None if there is nothing to run.
+        """
+        self.collect_uploads()
+
+        # check to see if our work is done
+        if self.is_datarun_finished():
+            # marked the run as done successfully
+            self.db.mark_datarun_complete(self.datarun.id)
+            LOGGER.warning('Datarun %d has ended.' % self.datarun.id)
+            return None
+
+        chosen = self._choose_classifier(hyperpartition_id)
+        if chosen is None:
+            return None
+
+        hyperpartition, params, fidelity_level, parent_id = chosen
+
+        LOGGER.debug('Creating classifier...')
+        classifier = self.db.start_classifier(hyperpartition_id=hyperpartition.id,
+                                              datarun_id=self.datarun.id,
+                                              host=HOSTNAME,
+                                              hyperparameter_values=params,
+                                              fidelity_level=fidelity_level,
+                                              parent_id=parent_id)
+
+        return classifier, hyperpartition, params, fidelity_level
+
+    def _mark_classifier_errored(self, classifier_id):
+        """Log the exception being handled and mark the classifier as errored."""
+        msg = traceback.format_exc()
+        LOGGER.error('Error testing classifier: datarun=%s' % str(self.datarun))
+        LOGGER.error(msg)
+        self.db.mark_classifier_errored(classifier_id, error_message=msg)
+
+    def _get_pool(self, processes, testing_ratio):
+        if self._pool is None:
+            # forking a process while another thread is running can deadlock
+            # the children on locks held by that thread, in logging or boto3.
+            self.close_uploader()
+
+            data = self.load_data(testing_ratio)
+            initargs = (data, self.dataset.k_classes, self.dataset.d_features)
+            self._pool = multiprocessing.Pool(processes, initializer=_init_pool,
+                                              initargs=initargs)
+            self._pool_nbytes = processes * self._get_nbytes(data)
+
+        return self._pool
+
+    def _collect_classifiers(self, wait=True):
+        """
+        Save the classifiers that have finished training in the pool.
+        If ``wait`` is True, block until at least one of them has finished.
+        """
+        while self._pending:
+            finished = [
+                classifier_id
+                for classifier_id, result in self._pending.items()
+                if result.ready()
+            ]
+
+            for classifier_id in finished:
+                result = self._pending.pop(classifier_id)
+                try:
+                    model, metrics = result.get()
+                    self._log_scores(model)
+                    LOGGER.debug('Saving classifier...')
+                    self.save_classifier(classifier_id, model, metrics)
+
+                except Exception:
+                    self._mark_classifier_errored(classifier_id)
+
+            if finished or not wait:
+                return
+
+            time.sleep(self._POOL_WAIT)
+
+    def run_classifiers(self, processes):
+        """
+        Concurrent version of run_classifier.
+
+        Keep up to ``processes`` classifiers training at the same time in a
+        pool of processes, proposing new hyperparameters as soon as a slot is
+        free, and return once at least one of them has finished and has been
+        saved. Classifiers that are still training are excluded from the
+        hyperpartition selection and tuning until they finish.
+        """
+        self.collect_uploads()
+
+        finished = self.is_datarun_finished()
+        if finished and not self._pending:
+            # marked the run as done successfully
+            self.db.mark_datarun_complete(self.datarun.id)
+            LOGGER.warning('Datarun %d has ended.' % self.datarun.id)
+            return
+
+        while not finished and len(self._pending) < processes:
+            chosen = self._choose_classifier()
+            if chosen is None:
+                break
+
+            hyperpartition, params, fidelity_level, parent_id = chosen
+
+            LOGGER.debug('Creating classifier...')
+            classifier = self.db.start_classifier(hyperpartition_id=hyperpartition.id,
+                                                  datarun_id=self.datarun.id,
+                                                  host=HOSTNAME,
+                                                  hyperparameter_values=params,
+                                                  fidelity_level=fidelity_level,
+                                                  parent_id=parent_id)
+
+            try:
+                # the processes of a pool cannot start processes of their own,
+                # so the cross-validation folds are fitted sequentially.
+                stop_below = self._get_stop_threshold(hyperpartition.id, fidelity_level)
+                model = self._make_model(hyperpartition.method, params, n_jobs=1,
+                                         stop_below=stop_below, fidelity_level=fidelity_level)
+                pool = self._get_pool(processes, model.testing_ratio)
+
+                LOGGER.debug('Testing classifier %d...' % classifier.id)
+                self._pending[classifier.id] = pool.apply_async(_train_test_model, (model, ))
+
+            except Exception:
+                self._mark_classifier_errored(classifier.id)
+                raise ClassifierError()
+
+            finished = self.is_datarun_finished()
+
+        self._collect_classifiers()
+
+    def close_pool(self):
+        """
+        Wait for the classifiers that are still training in the pool, save
+        them and shut the pool down.
+        """
+        if self._pool is not None:
+            while self._pending:
+                self._collect_classifiers()
+
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._pool_nbytes = 0
+
+    def close(self):
+        """
+        Shut the pool down, saving the classifiers that are still training in
+        it, and wait for the pending uploads to S3 to complete their classifiers.
+        """
+        self.close_pool()
+        self.close_uploader()
+
+    def close_uploader(self):
+        """
+        Wait for the pending uploads to S3 to complete their classifiers and
+        stop the uploader thread. It is started again on the next upload.
+        """
+        if self._uploader is not None:
+            self.collect_uploads(wait=True)
+            self._uploader.close()
+            self._uploader = None
@@ -13,6 +13,7 @@ install_requires = [
     'baytune>=0.2.5,<0.3',
     'boto3>=1.9.146,<2',
     'future>=0.16.0,<0.18',
+    'joblib>=0.11,<2',
     'pymysql>=0.9.3,<0.10',
     'numpy>=1.13.1,<1.17',
     'pandas>=0.22.0,<0.25',
@@ -61,7 +61,9 @@ def test__download_demo_path(mock_download_demo):
 @patch('atm.cli._get_atm')
 def test__work(mock__get_atm):
     # setup
-    args_mock = Mock(dataruns=[1], total_time=[1], save_files=False, cloud_mode=False)
+    args_mock = Mock(dataruns=[1], total_time=[1], save_files=False, cloud_mode=False,
+                     processes=1, tuner_batch_size=1, classifiers_per_claim=None,
+                     worker_cache_mb=None)
 
     # run
     cli._work(args_mock)
@@ -75,7 +77,11 @@ def test__work(mock__get_atm):
         save_files=False,
         cloud_mode=False,
         total_time=[1],
-        wait=False
+        wait=False,
+        processes=1,
+        tuner_batch_size=1,
+        classifiers_per_claim=None,
+        worker_cache_mb=None
     )
 
 
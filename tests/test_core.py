@@ -1,8 +1,9 @@
 import os
 
 import pytest
+from mock import Mock
 
-from atm.core import ATM
+from atm.core import ATM, _WorkerCache
 from atm.data import _get_local_path
 from atm.database import Database
 
@@ -90,3 +91,99 @@ def test_create_dataset(db):
 
     if os.path.exists(test_path_local):
         os.remove(test_path_local)
+
+
+def test_add_datarun(db):
+    atm = ATM(database=DB_PATH)
+
+    datarun = atm.add_datarun(dataset_id=1, methods=['logreg', 'dt'])
+
+    hyperpartitions = db.get_hyperpartitions(datarun_id=datarun.id)
+    expected = METHOD_HYPERPARTS['logreg'] + METHOD_HYPERPARTS['dt']
+    assert len(hyperpartitions) == expected
+    assert db.get_datarun(datarun.id).n_jobs == 1
+
+
+def test_add_datarun_invalid_min_fidelity(db):
+    atm = ATM(database=DB_PATH)
+
+    with pytest.raises(ValueError):
+        atm.add_datarun(dataset_id=1, methods=['dt'], min_fidelity=-0.5)
+
+    with pytest.raises(ValueError):
+        atm.add_datarun(dataset_id=1, methods=['dt'], min_fidelity=2)
+
+
+def test_add_datarun_per_partition(db):
+    atm = ATM(database=DB_PATH)
+
+    dataruns = atm.add_datarun(dataset_id=1, methods=['dt'], run_per_partition=True)
+
+    assert len(dataruns) == METHOD_HYPERPARTS['dt']
+    for datarun in dataruns:
+        assert len(db.get_hyperpartitions(datarun_id=datarun.id)) == 1
+
+
+def test__worker_cache():
+    db = Mock(**{'get_dataruns.return_value': None})
+    cache = _WorkerCache(db, max_bytes=100)
+    workers = [Mock(**{'data_nbytes.return_value': 40}) for _ in range(3)]
+    for datarun_id, worker in enumerate(workers):
+        cache.add(datarun_id, worker)
+
+    # using the first worker makes the second one the least recently used
+    assert cache.get(0) is workers[0]
+    cache.evict()
+
+    assert cache.get(1) is None
+    workers[1].close.assert_called_once_with()
+    assert not workers[0].close.called
+    assert not workers[2].close.called
+
+    cache.close()
+    workers[0].close.assert_called_once_with()
+    workers[2].close.assert_called_once_with()
+
+
+def test__worker_cache_evict_complete():
+    db = Mock(**{'get_dataruns.return_value': [Mock(id=1)]})
+    cache = _WorkerCache(db)
+    workers = [Mock(**{'data_nbytes.return_value': 0}) for _ in range(2)]
+    for datarun_id, worker in enumerate(workers):
+        cache.add(datarun_id, worker)
+
+    cache.evict()
+
+    db.get_dataruns.assert_called_once_with(ignore_pending=True, ignore_running=True,
+                                            ignore_complete=False, include_ids=[0, 1],
+                                            max_priority=False)
+    assert cache.get(1) is None
+    workers[1].close.assert_called_once_with()
+    assert cache.get(0) is workers[0]
+
+
+def test__worker_cache_max_workers():
+    db = Mock(**{'get_dataruns.return_value': None})
+    cache = _WorkerCache(db, max_workers=2)
+    workers = [Mock(**{'data_nbytes.return_value': 0}) for _ in range(3)]
+    for datarun_id, worker in enumerate(workers):
+        cache.add(datarun_id, worker)
+
+    cache.evict()
+
+    assert cache.get(0) is None
+    workers[0].close.assert_called_once_with()
+    assert cache.get(1) is workers[1]
+    assert cache.get(2) is workers[2]
+
+
+def test__worker_cache_suspend():
+    cache = _WorkerCache(Mock())
+    workers = [Mock() for _ in range(2)]
+    for datarun_id, worker in enumerate(workers):
+        cache.add(datarun_id, worker)
+
+    cache.suspend(keep=1)
+
+    workers[0].close.assert_called_once_with()
+    assert not workers[1].close.called
@@ -1,3 +1,5 @@
+import numpy as np
+import pandas as pd
 from mock import Mock, call, patch
 
 from atm import data
@@ -148,3 +150,56 @@ def test_get_demos(mock_boto3, mock_conf):
     client.list_objects.assert_called_once_with(Bucket='atm-data')
     mock_boto3.client.assert_called_once_with('s3', config=mock_conf.return_value)
     mock_conf.assert_called_once_with(signature_version=data.UNSIGNED)
+
+
+def test_load_data_cached(tmpdir):
+    """Test that the second load reads the cached parsed data."""
+
+    # setup
+
+    cache_dir = str(tmpdir.join('cache'))
+    csv_path = str(tmpdir.join('dataset.csv'))
+    pd.DataFrame({
+        'a': [1, 2, None, 4],
+        'b': ['x', 'y', 'z', 'x'],
+        'class': [0, 1, 0, 1],
+    }).to_csv(csv_path, index=False)
+
+    # run
+
+    first = data.load_data('dataset', csv_path, cache_dir=cache_dir)
+    with patch('atm.data.pd.read_csv') as mock_read_csv:
+        second = data.load_data('dataset', csv_path, cache_dir=cache_dir)
+
+    # assert
+
+    assert not mock_read_csv.called
+    assert tmpdir.join('cache', 'dataset.columns', 'metadata.json').check()
+    pd.testing.assert_frame_equal(first, second)
+    assert list(second.columns) == ['a', 'b', 'class']
+    assert second['b'].dtype == 'object'
+    assert len(second) == 3
+
+    # text columns are stored as category codes
+    cache_path = tmpdir.join('cache', 'dataset.columns')
+    assert np.load(str(cache_path.join('1.npy'))).dtype == np.int32
+    assert list(np.load(str(cache_path.join('1.categories.npy')))) == ['x', 'y']
+
+
+def test_load_data_not_cached(tmpdir):
+    """Test that nothing is cached if no cache_dir is given."""
+
+    # setup
+
+    csv_path = str(tmpdir.join('dataset.csv'))
+    pd.DataFrame({'a': [1, 2], 'class': [0, 1]}).to_csv(csv_path, index=False)
+
+    # run
+
+    with patch('atm.data.os.getcwd', return_value=str(tmpdir)):
+        result = data.load_data('dataset', csv_path)
+
+    # assert
+
+    assert len(result) == 2
+    assert tmpdir.listdir() == [tmpdir.join('dataset.csv')]
@@ -0,0 +1,230 @@
+import os
+
+import pytest
+from mock import Mock, patch
+from sqlalchemy import create_engine, inspect
+
+from atm.constants import ClassifierStatus
+from atm.database import Database, DBSession
+
+DB_CACHE_PATH = os.path.join(os.path.dirname(__file__), 'modelhub')
+
+
+@pytest.fixture
+def db(tmpdir):
+    # load cached ModelHub state. This database snapshot has one dataset
+    # (pollution.csv) and two dataruns, one complete and one with 33/100
+    # classifiers finished.
+    db = Database(dialect='sqlite', database=os.path.join(str(tmpdir), 'atm.db'))
+    db.from_csv(DB_CACHE_PATH)
+    return db
+
+
+def test_upgrade_schema(tmpdir):
+    # setup: a dataruns table created before the n_jobs column and the indexes existed
+    db_path = os.path.join(str(tmpdir), 'atm.db')
+    engine = create_engine('sqlite:///' + db_path)
+    engine.execute('CREATE TABLE dataruns (id INTEGER NOT NULL PRIMARY KEY, status VARCHAR(9))')
+    engine.execute("INSERT INTO dataruns (id, status) VALUES (1, 'pending')")
+
+    # run
+    Database(dialect='sqlite', database=db_path)
+
+    # assert
+    inspector = inspect(engine)
+    columns = [c['name'] for c in inspector.get_columns('dataruns')]
+    indexes = [i['name'] for i in inspector.get_indexes('dataruns')]
+    classifier_indexes = [i['name'] for i in inspector.get_indexes('classifiers')]
+
+    assert 'n_jobs' in columns
+    assert 'ix_dataruns_status_priority' in indexes
+    assert 'ix_classifiers_datarun_id_status' in classifier_indexes
+    assert engine.execute('SELECT id, n_jobs FROM dataruns').fetchall() == [(1, None)]
+
+
+def test_upgrade_schema_concurrent(tmpdir):
+    # setup: another process upgrades the schema after it has been inspected
+    db_path = os.path.join(str(tmpdir), 'atm.db')
+    Database(dialect='sqlite', database=db_path)
+    stale = Mock(**{'get_columns.return_value': [{'name': 'id'}], 'get_indexes.return_value': []})
+    inspectors = [stale]
+
+    def mock_inspect(engine):
+        return inspectors.pop() if inspectors else inspect(engine)
+
+    # run
+    with patch('atm.database.inspect', side_effect=mock_inspect):
+        Database(dialect='sqlite', database=db_path)
+
+    # assert
+    assert not inspectors
+
+
+def test_count_classifiers(db):
+    assert db.count_classifiers() == 133
+    assert db.count_classifiers(datarun_id=2) == 33
+    assert db.count_classifiers(datarun_id=2, status=ClassifierStatus.COMPLETE) == 31
+    assert db.get_datarun(2).completed_classifiers == 31
+
+
+def test_get_classifier_scores_extra_ids(db):
+    ids = sorted(c.id for c in db.get_classifiers(datarun_id=2))
+    rows = db.get_classifier_scores(2, 'cv_judgment_metric', min_id=ids[-2],
+                                    extra_ids=[ids[0]])
+
+    assert [row[0] for row in rows] == [ids[0], ids[-2], ids[-1]]
+
+
+def test_get_best_classifier(db):
+    for score_target in ['cv_judgment_metric', 'mu_sigma_judgment_metric']:
+        classifiers = db.get_classifiers(datarun_id=1, status=ClassifierStatus.COMPLETE)
+        expected = max(classifiers, key=lambda c: getattr(c, score_target))
+
+        best = db.get_best_classifier(score_target, datarun_id=1)
+
+        assert best.id == expected.id
+
+
+def test_get_best_classifier_cached(db):
+    best = db.get_best_classifier('cv', datarun_id=2, cached=True)
+
+    running = db.get_classifiers(datarun_id=2, status=ClassifierStatus.RUNNING)[0]
+    cv_score = float(best.cv_judgment_metric) + 0.01
+    db.complete_classifier(running.id, 'model', 'metrics', cv_score=cv_score,
+                           cv_stdev=0.0, test_score=0.5)
+
+    new_best = db.get_best_classifier('cv', datarun_id=2, cached=True)
+    assert new_best.id == running.id
+
+
+def test_get_best_classifier_full_fidelity(db):
+    best = db.get_best_classifier('cv', datarun_id=2, cached=True)
+
+    # classifiers trained on a subsample of the data never count as the best
+    classifier = db.start_classifier(hyperpartition_id=best.hyperpartition_id, datarun_id=2,
+                                     host='localhost', hyperparameter_values={},
+                                     fidelity_level=1, parent_id=best.id)
+    db.complete_classifier(classifier.id, 'model', 'metrics', cv_score=1.0,
+                           cv_stdev=0.0, test_score=1.0)
+
+    assert db.get_best_classifier('cv', datarun_id=2, cached=True).id == best.id
+    assert db.get_best_classifier('cv', datarun_id=2).id == best.id
+
+
+def test_get_best_classifier_stopped_early(db):
+    best = db.get_best_classifier('cv', datarun_id=2, cached=True)
+
+    # classifiers stopped early have no model and a partial score
+    running = db.get_classifiers(datarun_id=2, status=ClassifierStatus.RUNNING)[0]
+    db.complete_classifier(running.id, None, 'metrics', cv_score=1.0, cv_stdev=0.0,
+                           test_score=None, cv_folds=1)
+
+    assert db.get_best_classifier('cv', datarun_id=2, cached=True).id == best.id
+    assert db.get_best_classifier('mu_sigma', datarun_id=2).id != running.id
+
+
+def test_pool_arguments(tmpdir):
+    db = Database(dialect='sqlite', database=os.path.join(str(tmpdir), 'atm.db'),
+                  pool_recycle=3600)
+
+    assert db.engine.pool._recycle == 3600
+
+
+def test_dbsession_reentrant(db):
+    with DBSession(db):
+        session = db.session
+        db.get_datarun(2)
+        db.count_classifiers(datarun_id=2)
+
+        # nested sessions reuse the outer one and leave it open
+        with DBSession(db, commit=True):
+            assert db.session is session
+
+        assert db.session is session
+
+    assert db.session is None
+
+
+def test_hyperparameter_values_deferred(db):
+    with DBSession(db):
+        classifier = db.session.query(db.Classifier).first()
+        assert 'hyperparameter_values_64' not in vars(classifier)
+
+    # the classifiers returned by get_classifiers can be used without a session
+    classifier = db.get_classifiers(datarun_id=2)[0]
+    assert isinstance(classifier.hyperparameter_values, dict)
+
+    scores = db.get_datarun(2).get_scores()
+    assert list(scores.columns) == ['id', 'cv_judgment_metric', 'cv_judgment_metric_stdev',
+                                    'test_judgment_metric', 'rank']
+    assert len(scores) == 33
+
+
+def test_hyperparameter_values_json(db):
+    # old rows are stored as base 64 pickles
+    legacy = db.get_classifier(1)
+    values = legacy.hyperparameter_values
+    assert values == legacy.hyperparameter_values
+    assert values is not legacy.hyperparameter_values
+
+    classifier = db.start_classifier(hyperpartition_id=legacy.hyperpartition_id,
+                                     datarun_id=legacy.datarun_id, host='localhost',
+                                     hyperparameter_values=values)
+
+    assert classifier.hyperparameter_values_64.startswith('{')
+    assert db.get_classifier(classifier.id).hyperparameter_values == values
+
+
+def test_to_csv_from_csv(tmpdir):
+    db = Database(dialect='sqlite', database=os.path.join(str(tmpdir), 'atm.db'))
+    db.from_csv(DB_CACHE_PATH, chunksize=7)
+
+    snapshot = tmpdir.mkdir('snapshot')
+    db.to_csv(str(snapshot), chunksize=7)
+
+    new_db = Database(dialect='sqlite', database=os.path.join(str(tmpdir), 'new_atm.db'))
+    new_db.from_csv(str(snapshot), chunksize=7)
+
+    assert new_db.count_classifiers() == 133
+    hyperpartitions = new_db.get_hyperpartitions(ignore_gridding_done=False,
+                                                 ignore_errored=False)
+    assert len(hyperpartitions) == 40
+    classifier = new_db.get_classifier(1)
+    assert classifier.hyperparameter_values == db.get_classifier(1).hyperparameter_values
+    assert classifier.start_time == db.get_classifier(1).start_time
+
+
+def test_to_csv_from_csv_empty(tmpdir):
+    db = Database(dialect='sqlite', database=os.path.join(str(tmpdir), 'atm.db'))
+
+    snapshot = tmpdir.mkdir('snapshot')
+    db.to_csv(str(snapshot))
+
+    new_db = Database(dialect='sqlite', database=os.path.join(str(tmpdir), 'new_atm.db'))
+    new_db.from_csv(str(snapshot))
+
+    assert new_db.count_classifiers() == 0
+    assert new_db.get_dataruns(ignore_complete=False) is None
+    assert new_db.get_hyperpartitions(ignore_gridding_done=False,
+                                      ignore_errored=False) == []
+
+
+def test_claim_datarun(db):
+    datarun = db.get_datarun(2)
+    args = {
+        column: getattr(datarun, column)
+        for column in ['dataset_id', 'description', 'priority', 'selector', 'k_window', 'tuner',
+                       'gridding', 'r_minimum', 'budget_type', 'budget', 'metric',
+                       'score_target']
+    }
+    new_datarun = db.create_dataruns([args], [[]])[0]
+
+    # the least recently claimed datarun is claimed first
+    first = db.claim_datarun()
+    second = db.claim_datarun()
+    third = db.claim_datarun()
+
+    assert [first.id, second.id, third.id] == [2, new_datarun.id, 2]
+    assert second.status == 'running'
+    assert db.claim_datarun(include_ids=[1]) is None
+    assert db.claim_datarun(by_id=True).id == 2
@@ -0,0 +1,172 @@
+import numpy as np
+import pandas as pd
+from sklearn.metrics import (
+    accuracy_score, average_precision_score, cohen_kappa_score, f1_score, matthews_corrcoef,
+    roc_auc_score)
+from sklearn.pipeline import Pipeline
+from sklearn.tree import DecisionTreeClassifier
+
+from atm.constants import METRICS_BINARY, Metrics
+from atm.metrics import (
+    cross_validate_pipeline, get_metrics_binary, get_metrics_multiclass, get_per_class_matrix,
+    get_pr_roc_curves, rank_n_accuracy)
+
+
+def _get_data():
+    random = np.random.RandomState(0)
+    X = random.rand(100, 4)
+    y = (X[:, 0] + X[:, 1] > 1).astype(int)
+    return X, y
+
+
+def test_cross_validate_pipeline():
+    X, y = _get_data()
+    pipeline = Pipeline([('dt', DecisionTreeClassifier(random_state=0))])
+
+    scores, results = cross_validate_pipeline(pipeline, X, y, n_folds=5)
+
+    assert len(results) == 5
+    assert set(scores.keys()) == set(METRICS_BINARY)
+    for metric in METRICS_BINARY:
+        expected = [fold[metric] for fold in results]
+        np.testing.assert_array_equal(scores[metric], expected)
+
+
+def test_cross_validate_pipeline_as_frame():
+    X, y = _get_data()
+    pipeline = Pipeline([('dt', DecisionTreeClassifier(random_state=0))])
+
+    df, results = cross_validate_pipeline(pipeline, X, y, n_folds=5, as_frame=True)
+
+    assert isinstance(df, pd.DataFrame)
+    assert list(df.columns) == METRICS_BINARY
+    assert len(df) == 5
+
+
+def test_cross_validate_pipeline_parallel():
+    X, y = _get_data()
+    pipeline = Pipeline([('dt', DecisionTreeClassifier(random_state=0))])
+
+    scores, results = cross_validate_pipeline(pipeline, X, y, n_folds=5)
+    parallel_scores, parallel_results = cross_validate_pipeline(pipeline, X, y, n_folds=5,
+                                                                n_jobs=2)
+
+    assert len(results) == len(parallel_results) == 5
+    for metric in METRICS_BINARY:
+        np.testing.assert_allclose(scores[metric], parallel_scores[metric])
+
+
+def test_cross_validate_pipeline_stop_early():
+    X, y = _get_data()
+    pipeline = Pipeline([('dt', DecisionTreeClassifier(random_state=0))])
+
+    # no classifier can score above 1, so it stops after the first group of folds
+    scores, results = cross_validate_pipeline(pipeline, X, y, n_folds=5, n_jobs=2,
+                                              stop_metric='accuracy', stop_below=1.1)
+
+    assert len(results) == 2
+    assert not np.isnan(scores['accuracy'][:2]).any()
+    assert np.isnan(scores['accuracy'][2:]).all()
+
+    # and it never stops if the folds score above the threshold
+    scores, results = cross_validate_pipeline(pipeline, X, y, n_folds=5, n_jobs=2,
+                                              stop_metric='accuracy', stop_below=0.0)
+
+    assert len(results) == 5
+
+
+def test_rank_n_accuracy():
+    y_true = np.array([0, 1, 2, 3])
+    y_prob_mat = np.array([
+        [0.7, 0.1, 0.1, 0.1],
+        [0.5, 0.3, 0.1, 0.1],
+        [0.4, 0.3, 0.2, 0.1],
+        [0.1, 0.2, 0.3, 0.4],
+    ])
+
+    assert rank_n_accuracy(y_true, y_prob_mat, n=1) == 0.5
+    assert rank_n_accuracy(y_true, y_prob_mat, n=2) == 0.75
+    assert rank_n_accuracy(y_true, y_prob_mat, n=0.75) == 1.0
+    assert rank_n_accuracy(y_true, y_prob_mat, n=0.1) == 0.0
+
+
+def test_get_metrics_binary():
+    random = np.random.RandomState(0)
+    y_true = random.randint(2, size=50)
+    y_pred = random.randint(2, size=50)
+    y_pred_probs = random.rand(50, 2)
+
+    results = get_metrics_binary(y_true, y_pred, y_pred_probs)
+
+    y_true_bin = np.column_stack((1 - y_true, y_true))
+    assert np.isclose(results[Metrics.ACCURACY], accuracy_score(y_true, y_pred))
+    assert np.isclose(results[Metrics.COHEN_KAPPA], cohen_kappa_score(y_true, y_pred))
+    assert np.isclose(results[Metrics.F1], f1_score(y_true, y_pred))
+    assert np.isclose(results[Metrics.MCC], matthews_corrcoef(y_true, y_pred))
+    assert np.isclose(results[Metrics.ROC_AUC], roc_auc_score(y_true, y_pred_probs[:, 1]))
+    assert np.isclose(results[Metrics.AP],
+                      average_precision_score(y_true_bin, np.column_stack(
+                          (-y_pred_probs[:, 1], y_pred_probs[:, 1]))))
+
+
+def test_get_metrics_multiclass():
+    random = np.random.RandomState(0)
+    y_true = random.randint(4, size=50)
+    y_pred = random.randint(3, size=50)
+    y_pred_probs = random.rand(50, 5)
+
+    results = get_metrics_multiclass(y_true, y_pred, y_pred_probs, include_per_class=True)
+
+    assert np.isclose(results[Metrics.ACCURACY], accuracy_score(y_true, y_pred))
+    assert np.isclose(results[Metrics.COHEN_KAPPA], cohen_kappa_score(y_true, y_pred))
+    assert np.isclose(results[Metrics.F1_MICRO], f1_score(y_true, y_pred, average='micro'))
+    assert np.isclose(results[Metrics.F1_MACRO], f1_score(y_true, y_pred, average='macro'))
+
+    assert sorted(results['class_wise'].keys()) == list(range(5))
+    for cls, class_res in results['class_wise'].items():
+        expected = get_metrics_binary((y_true == cls).astype(int), (y_pred == cls).astype(int),
+                                      np.column_stack((1 - y_pred_probs[:, cls],
+                                                       y_pred_probs[:, cls])))
+        for metric, score in expected.items():
+            assert np.isclose(class_res[metric], score, equal_nan=True)
+
+    # class 4 is never true nor predicted
+    assert class_res[Metrics.F1] == 0.0
+    assert class_res[Metrics.MCC] == 0.0
+    assert np.isnan(class_res[Metrics.COHEN_KAPPA])
+
+
+def test_get_per_class_matrix():
+    y = np.array([2, 0, 5, 2])
+
+    y_bin = get_per_class_matrix(y)
+    expected = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1], [0, 1, 0]])
+    assert y_bin.dtype == np.uint8
+    np.testing.assert_array_equal(y_bin, expected)
+
+    # unknown classes get no column, and the column order follows the given classes
+    y_bin = get_per_class_matrix(y, classes=[5, 1, 2])
+    np.testing.assert_array_equal(y_bin, [[0, 0, 1], [0, 0, 0], [1, 0, 0], [0, 0, 1]])
+
+    y_sparse = get_per_class_matrix(y, classes=[5, 1, 2], sparse=True)
+    np.testing.assert_array_equal(y_sparse.toarray(), y_bin)
+
+
+def test_get_pr_roc_curves():
+    random = np.random.RandomState(0)
+    y_true = random.randint(2, size=1000)
+    y_pred_probs = random.rand(1000)
+
+    full = get_pr_roc_curves(y_true, y_pred_probs)
+    results = get_pr_roc_curves(y_true, y_pred_probs, curve_points=10)
+
+    roc, full_roc = results[Metrics.ROC_CURVE], full[Metrics.ROC_CURVE]
+    assert len(roc['fprs']) == len(roc['tprs']) == len(roc['thresholds']) == 10
+    assert roc['fprs'][0] == full_roc['fprs'][0]
+    assert roc['fprs'][-1] == full_roc['fprs'][-1] == 1.0
+
+    pr, full_pr = results[Metrics.PR_CURVE], full[Metrics.PR_CURVE]
+    assert len(pr['precisions']) == len(pr['recalls']) == 10
+    assert len(pr['thresholds']) == 9
+    assert pr['recalls'][-1] == full_pr['recalls'][-1] == 0.0
+    assert pr['thresholds'][0] == full_pr['thresholds'][0]
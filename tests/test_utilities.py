@@ -1,3 +1,5 @@
+import numpy as np
+from btb import HyperParameter
 from btb.selection.selector import Selector
 
 from atm import utilities
@@ -14,3 +16,30 @@ def test_make_selector():
     for selector_class in SELECTORS.values():
         selector = utilities.get_instance(selector_class, **kwargs)
         assert isinstance(selector, Selector)
+
+
+def test_object_to_json():
+    params = {'C': np.float64(0.5), 'max_iter': np.int64(10), 'kernel': 'rbf', 'shrinking': True}
+
+    encoded = utilities.object_to_json(params)
+
+    assert utilities.json_to_object(encoded) == {
+        'C': 0.5, 'max_iter': 10, 'kernel': 'rbf', 'shrinking': True}
+
+
+def test_object_to_json_hyperparameters():
+    tunables = [('C', HyperParameter('float_exp', [1e-05, 100000]))]
+
+    decoded = utilities.json_to_object(utilities.object_to_json(tunables))
+
+    name, hyperparameter = decoded[0]
+    assert name == 'C'
+    assert isinstance(hyperparameter, HyperParameter)
+    assert hyperparameter.param_type == tunables[0][1].param_type
+    assert hyperparameter.range == tunables[0][1].range
+
+
+def test_json_to_object_base_64():
+    params = {'C': 0.5, 'kernel': 'rbf'}
+
+    assert utilities.json_to_object(utilities.object_to_base_64(params)) == params
@@ -10,13 +10,13 @@ from btb.tuning import GP
 from btb.tuning.tuner import BaseTuner
 from mock import ANY, Mock, patch
 
-from atm.classifier import Model
+from atm.classifier import Model, subsample
 from atm.config import DatasetConfig, RunConfig
-from atm.constants import METRICS_BINARY, TIME_FMT
+from atm.constants import METRICS_BINARY, TIME_FMT, ClassifierStatus
 from atm.core import ATM
 from atm.database import Database, DBSession
 from atm.utilities import load_metrics, load_model
-from atm.worker import ClassifierError, Worker
+from atm.worker import ClassifierError, S3Uploader, Worker
 
 CURDIR = os.path.dirname(__file__)
 DEMOS_PATH = os.path.realpath(os.path.join(CURDIR, os.pardir, 'atm', 'demos'))
@@ -154,8 +154,7 @@ def test_select_hyperpartition(worker):
     connection is working.
     """
     worker.db.get_hyperpartitions = Mock(return_value=[Mock(id=1)])
-    clf_mock = Mock(hyperpartition_id=1, cv_judgment_metric=0.5)
-    worker.db.get_classifiers = Mock(return_value=[clf_mock])
+    worker.db.get_classifier_scores = Mock(return_value=[(1, 1, ClassifierStatus.COMPLETE, 0.5)])
     worker.selector.select = Mock(return_value=1)
 
     hp = worker.select_hyperpartition()
@@ -164,6 +163,44 @@ def test_select_hyperpartition(worker):
     assert hp.id == 1
 
 
+def test_select_hyperpartition_incremental(worker):
+    worker.db.get_hyperpartitions = Mock(return_value=[Mock(id=1), Mock(id=2)])
+    worker.db.get_classifier_scores = Mock(return_value=[
+        (1, 1, ClassifierStatus.COMPLETE, 0.5),
+        (2, 1, ClassifierStatus.RUNNING, None),
+        (3, 2, ClassifierStatus.ERRORED, None),
+    ])
+    worker.selector.select = Mock(return_value=1)
+
+    worker.select_hyperpartition()
+
+    worker.selector.select.assert_called_with({1: [0.5, 0.0], 2: [0.0]})
+
+    # only the new classifiers and the running one are fetched again
+    worker.db.get_classifier_scores.return_value = [
+        (2, 1, ClassifierStatus.RUNNING, None),
+        (4, 1, ClassifierStatus.COMPLETE, 0.6),
+    ]
+
+    worker.select_hyperpartition()
+
+    worker.db.get_classifier_scores.assert_called_with(
+        worker.datarun.id, worker.datarun.score_target, min_id=4, extra_ids={2})
+    worker.selector.select.assert_called_with({1: [0.5, 0.0, 0.6], 2: [0.0]})
+
+    # a classifier that stays running does not hold the watermark back
+    worker.db.get_classifier_scores.return_value = [
+        (2, 1, ClassifierStatus.COMPLETE, 0.7),
+        (5, 2, ClassifierStatus.COMPLETE, 0.4),
+    ]
+
+    worker.select_hyperpartition()
+
+    worker.db.get_classifier_scores.assert_called_with(
+        worker.datarun.id, worker.datarun.score_target, min_id=5, extra_ids={2})
+    worker.selector.select.assert_called_with({1: [0.5, 0.7, 0.6], 2: [0.0, 0.4]})
+
+
 def test_tune_hyperparameters(worker, hyperpartition):
     """
     This won't test that BTB is working correctly, just that the ATM-BTB
@@ -184,6 +221,113 @@ def test_tune_hyperparameters(worker, hyperpartition):
     mock_tuner.propose.assert_called()
 
 
+def test_tune_hyperparameters_batch(worker, hyperpartition):
+    proposals = [{'a': 1}, {'a': 2}, {'a': 1}]
+    mock_tuner = Mock()
+    mock_tuner.propose.return_value = proposals
+    worker.Tuner = Mock(return_value=mock_tuner)
+    worker.tuner_batch_size = 3
+
+    with patch('atm.worker.update_params', side_effect=lambda params, **kwargs: params):
+        first = worker.tune_hyperparameters(hyperpartition)
+        second = worker.tune_hyperparameters(hyperpartition)
+        third = worker.tune_hyperparameters(hyperpartition)
+
+    # duplicates are dropped and a new batch is proposed once the queue is empty
+    assert [first, second, third] == [{'a': 1}, {'a': 2}, {'a': 1}]
+    assert mock_tuner.propose.call_count == 2
+    mock_tuner.propose.assert_called_with(3)
+
+
+def test_tune_hyperparameters_incremental(worker, hyperpartition):
+    mock_tuner = Mock()
+    worker.Tuner = Mock(return_value=mock_tuner)
+
+    def classifier(id, status, score=None):
+        return Mock(id=id, status=status, cv_judgment_metric=score,
+                    hyperparameter_values={'a': id}, fidelity_level=None)
+
+    clf1 = classifier(1, ClassifierStatus.COMPLETE, 0.1)
+    clf2 = classifier(2, ClassifierStatus.RUNNING)
+    clf3 = classifier(3, ClassifierStatus.COMPLETE, 0.3)
+    worker.db.get_classifiers = Mock(return_value=[clf1, clf2, clf3])
+
+    with patch('atm.worker.update_params'):
+        worker.tune_hyperparameters(hyperpartition)
+
+        worker.db.get_classifiers.assert_called_once_with(
+            hyperpartition_id=hyperpartition.id, min_id=1, extra_ids=set())
+        mock_tuner.add.assert_called_once_with([{'a': 1}, {'a': 3}], [0.1, 0.3])
+
+        # the running classifier completes and nothing else is added twice
+        clf2.status = ClassifierStatus.COMPLETE
+        clf2.cv_judgment_metric = 0.2
+        worker.db.get_classifiers.return_value = [clf2]
+        worker.tune_hyperparameters(hyperpartition)
+
+    worker.db.get_classifiers.assert_called_with(
+        hyperpartition_id=hyperpartition.id, min_id=4, extra_ids={2})
+    mock_tuner.add.assert_called_with([{'a': 2}], [0.2])
+    assert worker.Tuner.call_count == 1
+
+
+def test__get_stop_threshold(worker):
+    worker.db.get_classifiers_values = Mock(
+        return_value=[(0.5, None), (0.9, None), (0.7, None), (0.1, 2), (0.3, 2)])
+    assert worker._get_stop_threshold(1) is None
+
+    worker.datarun.early_stopping = True
+    assert worker._get_stop_threshold(1) == 0.7
+    assert worker._get_stop_threshold(1, fidelity_level=2) == 0.2
+
+    worker.datarun.r_minimum = 4
+    assert worker._get_stop_threshold(1) is None
+
+    worker.datarun.r_minimum = 2
+    worker.datarun.score_target = 'mu_sigma_judgment_metric'
+    assert worker._get_stop_threshold(1) is None
+
+
+def test__get_base_fidelity_level(worker):
+    assert worker._get_base_fidelity_level() is None
+
+    worker.datarun.min_fidelity = 0.1
+    assert worker._get_base_fidelity_level() == 2
+
+    worker.datarun.min_fidelity = 1.0 / 9
+    assert worker._get_base_fidelity_level() == 2
+
+    worker.datarun.min_fidelity = 0.5
+    assert worker._get_base_fidelity_level() is None
+
+
+def test__get_promotion(worker, hyperpartition):
+    def add_classifier(fidelity_level, score=None, parent_id=None):
+        classifier = worker.db.start_classifier(hyperpartition.id, worker.datarun.id,
+                                                'localhost', {}, fidelity_level=fidelity_level,
+                                                parent_id=parent_id)
+        if score is not None:
+            worker.db.complete_classifier(classifier.id, None, None, score, 0, score)
+
+        return classifier.id
+
+    ids = [add_classifier(2, score) for score in [0.5, 0.9, 0.7, 0.8]]
+    add_classifier(2)    # still running
+    add_classifier(2, 0.6)
+
+    # the best third of the level is promoted
+    assert worker._get_promotion(2) == (ids[1], 1)
+
+    # promoted classifiers are skipped, and the next level comes first
+    promoted_id = add_classifier(1, 0.9, parent_id=ids[1])
+    add_classifier(1, 0.8, parent_id=ids[3])
+    add_classifier(1, 0.7)
+    assert worker._get_promotion(2) == (promoted_id, 0)
+
+    add_classifier(0, 0.9, parent_id=promoted_id)
+    assert worker._get_promotion(2) is None
+
+
 def test_test_classifier(db, dataset):
     metric = 'roc_auc'
     worker = get_new_worker(metric=metric, score_target='mu_sigma')
@@ -197,6 +341,52 @@ def test_test_classifier(db, dataset):
     assert model.cv_judgment_metric_stdev == np.std(judge_mets)
 
 
+def test_test_classifier_fidelity(db, dataset):
+    worker = get_new_worker()
+
+    model, metrics = worker.test_classifier(method='dt', params=DT_PARAMS, fidelity_level=1)
+
+    assert model.fidelity == 1.0 / 3
+    assert len(metrics['cv']) == model.N_FOLDS
+    assert metrics['test']
+
+
+def test_test_classifier_fidelity_small_classes():
+    # 1 / 9 of 35 rows per class is fewer rows than cross-validation folds
+    X = np.random.RandomState(0).rand(105, 4)
+    y = np.repeat([0, 1, 2], 35)
+    data = (None, X, y, X, y)
+    model = Model(method='dt', params=DT_PARAMS, judgment_metric='f1',
+                  class_column='class', fidelity=1.0 / 9)
+
+    metrics = model.train_test_encoded(data, 3, 4)
+
+    assert len(metrics['cv']) == model.N_FOLDS
+    assert metrics['test']
+
+
+def test_subsample():
+    X = np.arange(40).reshape(20, 2)
+    y = np.array([0] * 12 + [1] * 6 + [2] * 2)
+
+    X_sub, y_sub = subsample(X, y, 0.5, min_per_class=5)
+
+    assert list(np.bincount(y_sub)) == [6, 5, 2]
+    assert (y[X_sub[:, 0] // 2] == y_sub).all()
+
+
+def test_test_classifier_caches_data(db, dataset):
+    worker = get_new_worker()
+    worker.dataset.load = Mock(wraps=worker.dataset.load)
+
+    model_1, _ = worker.test_classifier(method='dt', params=DT_PARAMS)
+    model_2, _ = worker.test_classifier(method='dt', params=DT_PARAMS)
+
+    worker.dataset.load.assert_called_once_with(0.3, worker.random_state)
+    assert model_1.random_state == model_2.random_state == worker.random_state
+    assert model_1.encoder is model_2.encoder
+
+
 def test_save_classifier(db, datarun, model, metrics):
     worker = Worker(db, datarun, models_dir=MODEL_DIR, metrics_dir=METRIC_DIR)
     hp = db.get_hyperpartitions(datarun_id=worker.datarun.id)[0]
@@ -220,6 +410,66 @@ def test_save_classifier(db, datarun, model, metrics):
         assert load_metrics(clf, METRIC_DIR) == metrics
 
 
+def test_save_classifier_cloud_mode(db, datarun, model, metrics):
+    s3_client = Mock()
+    worker = Worker(db, datarun, models_dir=MODEL_DIR, metrics_dir=METRIC_DIR,
+                    cloud_mode=True, s3_bucket='bucket', s3_folder='folder',
+                    s3_client=s3_client)
+    hp = db.get_hyperpartitions(datarun_id=worker.datarun.id)[0]
+    classifier = worker.db.start_classifier(hyperpartition_id=hp.id,
+                                            datarun_id=worker.datarun.id,
+                                            host='localhost',
+                                            hyperparameter_values=DT_PARAMS)
+
+    # the classifier is only completed once its files are uploaded
+    worker.save_classifier(classifier.id, model, metrics)
+    assert db.get_classifier(classifier.id).status == ClassifierStatus.RUNNING
+
+    worker.close()
+
+    clf = db.get_classifier(classifier.id)
+    assert clf.status == ClassifierStatus.COMPLETE
+    assert clf.model_location.startswith('s3://bucket/')
+    assert clf.model_location.endswith('.model')
+    assert clf.metrics_location.startswith('s3://bucket/')
+    assert s3_client.upload_file.call_count == 2
+
+
+def test_s3_uploader():
+    client = Mock()
+    uploader = S3Uploader('bucket', client=client)
+
+    uploader.submit(1, [('model.pkl', 'folder/model.pkl'), (None, None)])
+    finished = uploader.get_finished(wait=True)
+    uploader.close()
+
+    assert finished == [(1, ['s3://bucket/folder/model.pkl', None], None)]
+    client.upload_file.assert_called_once_with('model.pkl', 'bucket', 'folder/model.pkl',
+                                               Config=uploader.transfer_config)
+    assert uploader.get_finished() == []
+
+
+@patch('atm.worker.S3Uploader._RETRY_WAIT', 0)
+def test_s3_uploader_retries():
+    client = Mock()
+    client.upload_file.side_effect = [ValueError('qwerty'), None]
+    uploader = S3Uploader('bucket', client=client, max_retries=1)
+
+    assert uploader.upload('model.pkl', 'model.pkl') == 's3://bucket/model.pkl'
+    assert client.upload_file.call_count == 2
+
+    # give up after max_retries
+    client.upload_file.side_effect = ValueError('qwerty')
+    uploader.submit(1, [('model.pkl', 'model.pkl')])
+    (job_id, urls, error), = uploader.get_finished(wait=True)
+    uploader.close()
+
+    assert job_id == 1
+    assert urls is None
+    assert 'qwerty' in error
+    assert client.upload_file.call_count == 4
+
+
 def test_is_datarun_finished(db, dataset, datarun):
     r1 = db.get_datarun(1)
     worker = Worker(db, r1)
@@ -256,8 +506,11 @@ def test_run_classifier(worker, hyperpartition, model, metrics):
     worker.db.start_classifier.assert_called_once_with(hyperpartition_id=hyperpartition.id,
                                                        datarun_id=worker.datarun.id,
                                                        host=ANY,
-                                                       hyperparameter_values=DT_PARAMS)
-    worker.test_classifier.assert_called_once_with(hyperpartition.method, DT_PARAMS)
+                                                       hyperparameter_values=DT_PARAMS,
+                                                       fidelity_level=None,
+                                                       parent_id=None)
+    worker.test_classifier.assert_called_once_with(hyperpartition.method, DT_PARAMS, None,
+                                                   None)
     worker.save_classifier.assert_called_once_with(ANY, model, metrics)
 
     # make sure hyperpartition specification works
@@ -273,3 +526,66 @@ def test_run_classifier(worker, hyperpartition, model, metrics):
         worker.run_classifier()
     worker.db.mark_classifier_errored.assert_called_with(
         ANY, error_message=StringWith('qwerty'))
+
+
+def test_run_classifier_session(worker, hyperpartition, model, metrics):
+    # no database session is held open while the classifier is trained
+    sessions = []
+
+    def test_classifier(*args):
+        sessions.append(worker.db.session)
+        return model, metrics
+
+    worker.select_hyperpartition = Mock(return_value=hyperpartition)
+    worker.tune_hyperparameters = Mock(return_value=DT_PARAMS)
+    worker.test_classifier = test_classifier
+    worker.save_classifier = Mock(side_effect=lambda *args: sessions.append(worker.db.session))
+
+    worker.run_classifier()
+
+    assert sessions[0] is None
+    assert sessions[1] is not None
+
+
+def test_run_classifiers(db, dataset):
+    worker = get_new_worker(methods=['dt'], budget=4)
+
+    worker.run_classifiers(2)
+
+    # each process of the pool holds a copy of the cached data
+    nbytes = worker.data_nbytes()
+    worker.close_pool()
+    assert worker.data_nbytes() * 3 == nbytes
+    worker.close()
+
+    classifiers = worker.db.get_classifiers(datarun_id=worker.datarun.id)
+    assert len(classifiers) == 2
+    assert all(c.status == ClassifierStatus.COMPLETE for c in classifiers)
+    assert worker._pool is None
+
+
+def test__get_pool_stops_uploader(db, dataset):
+    worker = get_new_worker(methods=['dt'])
+    uploader = worker._uploader = Mock()
+    worker.collect_uploads = Mock()
+
+    with patch('atm.worker.multiprocessing.Pool') as pool_mock:
+        assert worker._get_pool(2, 0.3) is pool_mock.return_value
+
+    worker.collect_uploads.assert_called_once_with(wait=True)
+    uploader.close.assert_called_once_with()
+    assert worker._uploader is None
+
+
+def test_run_classifiers_error(db, dataset):
+    worker = get_new_worker(methods=['dt'], budget=4)
+    worker._make_model = Mock(side_effect=ValueError('qwerty'))
+
+    with pytest.raises(ClassifierError):
+        worker.run_classifiers(2)
+
+    worker.close()
+
+    classifiers = worker.db.get_classifiers(datarun_id=worker.datarun.id)
+    assert [c.status for c in classifiers] == [ClassifierStatus.ERRORED]
+    assert 'qwerty' in classifiers[0].error_message